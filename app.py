@@ -1,23 +1,57 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import os
 import json
 from datetime import datetime
 from PIL import Image, ImageOps
-from fpdf import FPDF
 import urllib.parse
-from pypdf import PdfWriter, PdfReader # NOUVEAU : Pour fusionner les dossiers
+import threading
+import sqlite3
+from contextlib import closing, contextmanager, nullcontext
+from collections import OrderedDict, deque
+import hashlib
+import re
+import io
+import shutil
+import tempfile
+import unicodedata
+import bisect
+import importlib.machinery
+import time
+import functools
+import cProfile
+import pstats
+from dossier import generer_pdf_complet, dossier_filename, export_flotte
 
 # --- 1. CONFIGURATION ---
 st.set_page_config(page_title="Garage Manager V16", page_icon="🏎️", layout="wide")
 
 os.makedirs("photos", exist_ok=True)
 os.makedirs("factures", exist_ok=True)
+CACHE_DIR = ".cache"
+os.makedirs(os.path.join(CACHE_DIR, "thumbs"), exist_ok=True)
+EXPORT_DIR = os.path.join(CACHE_DIR, "exports")
+os.makedirs(EXPORT_DIR, exist_ok=True)
 
 FILES = {
     "maintenance": "base_entretien_propre.csv",
     "carburant": "suivi_carburant.csv",
-    "config": "garage_config.json"
+    "config": "garage_config.json",
+    "db": "garage.db",
+    "blobs": os.path.join("factures", "index.sqlite")
+}
+# "sqlite" (défaut) ou "csv" pour l'ancien stockage fichier
+STORAGE = os.environ.get("GARAGE_STORAGE", "sqlite")
+# Instrumentation opt-in : GARAGE_PROFILE=1 ou bascule "Mode performance" de la barre latérale
+PERF_ENABLED = os.environ.get("GARAGE_PROFILE") == "1" or st.session_state.get("perf_mode", False)
+PERF_LOG = os.environ.get("GARAGE_PROFILE_LOG") # Fichier JSONL optionnel, une trace par rerun
+PERF_LAST_N = 20
+PERF_PROFILE_TOP = 30
+
+COLUMNS = {
+    "maintenance": ['Date', 'Vehicule', 'Kilometrage', 'Description', 'Cout', 'Facture'],
+    "carburant": ['Date', 'Vehicule', 'Kilometrage', 'Litres', 'Prix_Total', 'Conso_Calc']
 }
 
 # --- 2. DONNÉES PERSO ---
@@ -32,51 +66,1005 @@ DATA_INIT = {
 
 # --- 3. FONCTIONS ---
 
-def load_config():
-    data = {}
-    if os.path.exists(FILES["config"]):
+# --- Cache partagé (toutes sessions), invalidé par mtime + taille du fichier ---
+@st.cache_resource
+def _shared_cache():
+    return {"lock": threading.Lock(), "write_lock": threading.Lock(), "entries": {}}
+
+def file_signature(path):
+    try:
+        s = os.stat(path)
+        return (s.st_mtime_ns, s.st_size)
+    except FileNotFoundError: return None
+
+def cache_get(name, sig):
+    cache = _shared_cache()
+    with cache["lock"]:
+        entry = cache["entries"].get(name)
+    if entry and sig is not None and entry[0] == sig: return entry[1]
+    return None
+
+def cache_put(name, sig, value):
+    cache = _shared_cache()
+    with cache["lock"]:
+        if sig is None: cache["entries"].pop(name, None)
+        else: cache["entries"][name] = (sig, value)
+
+def _normalize(df, key):
+    df['Date'] = pd.to_datetime(df['Date'], errors='coerce')
+    for c in COLUMNS[key]:
+        if c not in df.columns: df[c] = None
+    if key == "maintenance": df['Facture'] = df['Facture'].astype(str).replace('nan', None)
+    return df
+
+def _empty(key): return _normalize(pd.DataFrame(columns=COLUMNS[key]), key)
+
+def _sql_value(v):
+    if v is None or (not isinstance(v, str) and pd.isna(v)): return None
+    if isinstance(v, datetime) or hasattr(v, "strftime"): return v.strftime("%Y-%m-%d")
+    return v.item() if hasattr(v, "item") else v
+
+# --- Stockage : backends interchangeables (SQLite par défaut, CSV/JSON historique) ---
+class CsvStorage:
+    """Stockage historique : un CSV par table, réécrit en entier à chaque modification.
+    Colonne `id` persistée (les anciens fichiers sans `id` prennent leurs positions, figées à la prochaine écriture)"""
+    indexed = False
+
+    def signature(self, key): return file_signature(FILES[key])
+
+    def read(self, key, car=None):
+        try: df = pd.read_csv(FILES[key])
+        except FileNotFoundError: return _empty(key)
+        if 'id' in df.columns:
+            df = df.set_index('id')
+            df.index.name = None
+        df = _normalize(df, key)
+        return df if car is None else df[df['Vehicule'] == car]
+
+    def write(self, df, key):
+        if not (df.index.is_unique and pd.api.types.is_integer_dtype(df.index)): df = df.set_axis(pd.RangeIndex(len(df)))
+        df.to_csv(FILES[key], index_label='id')
+        return df.index
+
+    def _next_id(self, df): return int(df.index.max()) + 1 if len(df) else 0
+
+    def insert(self, key, rows):
+        df = self.read(key)
+        ids = list(range(self._next_id(df), self._next_id(df) + len(rows)))
+        self.write(pd.concat([df, rows.set_axis(ids)]), key)
+        return ids
+
+    def update(self, key, changes):
+        df = self.read(key)
+        for row_id, values in changes.items():
+            # Ligne supprimée entre-temps : ignorée, comme l'UPDATE ... WHERE id = ? de SQLite
+            if row_id not in df.index: continue
+            for col, val in values.items(): df.at[row_id, col] = val
+        self.write(df, key)
+
+    def delete(self, key, ids=None, car=None):
+        df = self.read(key)
+        mask = df.index.isin(ids or []) | ((df['Vehicule'] == car) if car is not None else False)
+        self.write(df[~mask], key)
+
+    def bulk_insert(self, key, chunks):
+        """Ajout en flux dans une copie du fichier, substituée à l'original seulement à la fin"""
+        path = FILES[key]
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+        os.close(fd)
+        try:
+            header, next_id = None, 0
+            if os.path.exists(path):
+                shutil.copyfile(path, tmp)
+                header = pd.read_csv(path, nrows=0).columns.tolist()
+                # Sans colonne id (ancien fichier), les lignes ajoutées prennent simplement les positions suivantes
+                if 'id' in header:
+                    ids = pd.read_csv(path, usecols=['id'])['id']
+                    next_id = int(ids.max()) + 1 if len(ids) else 0
+                else: next_id = None
+            n = 0
+            for rows in chunks:
+                if next_id is not None: rows = rows.assign(id=range(next_id, next_id + len(rows))); next_id += len(rows)
+                rows.reindex(columns=header or ['id'] + COLUMNS[key]).to_csv(tmp, mode='a', header=header is None, index=False)
+                header = header or ['id'] + COLUMNS[key]
+                n += len(rows)
+            os.replace(tmp, path)
+            return n
+        finally:
+            if os.path.exists(tmp): os.remove(tmp)
+
+    def vehicles_of(self, key, ids):
+        df = self.read(key)
+        return df.loc[df.index.intersection(ids), 'Vehicule'].dropna().unique().tolist()
+
+    def read_config(self):
+        if not os.path.exists(FILES["config"]): return {}
         with open(FILES["config"], "r") as f:
-            try: data = json.load(f)
-            except: data = {}
+            try: return json.load(f)
+            except: return {}
+
+    def write_config(self, data, text):
+        with open(FILES["config"], "w") as f: f.write(text)
+
+class SqliteStorage:
+    """Base SQLite en WAL : écritures ligne à ligne, lectures par véhicule via index.
+    garage_config.json reste le miroir éditable de la table config : réécrit à chaque sauvegarde,
+    réimporté dès que son mtime diffère de celui noté dans meta (modification à la main)"""
+    indexed = True
+
+    def __init__(self, path):
+        self.path = path
+        with closing(self._connect()) as con:
+            con.execute("PRAGMA journal_mode=WAL")
+            with con:
+                fresh = con.execute("SELECT name FROM sqlite_master WHERE name = 'meta'").fetchone() is None
+                for key, cols in COLUMNS.items():
+                    types = {"Date": "TEXT", "Vehicule": "TEXT", "Kilometrage": "INTEGER", "Description": "TEXT", "Facture": "TEXT"}
+                    defs = ", ".join(f"{c} {types.get(c, 'REAL')}" for c in cols)
+                    # AUTOINCREMENT : un id supprimé n'est jamais réattribué (les patchs du data_editor s'y fient)
+                    table = f"CREATE TABLE {key} (id INTEGER PRIMARY KEY AUTOINCREMENT, {defs})"
+                    old = con.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (key,)).fetchone()
+                    if old is None: con.execute(table)
+                    elif "AUTOINCREMENT" not in old[0].upper():
+                        con.execute(f"ALTER TABLE {key} RENAME TO {key}_old")
+                        con.execute(table)
+                        con.execute(f"INSERT INTO {key} (id, {', '.join(cols)}) SELECT id, {', '.join(cols)} FROM {key}_old")
+                        con.execute(f"DROP TABLE {key}_old")
+                    con.execute(f"CREATE INDEX IF NOT EXISTS idx_{key}_date ON {key} (Vehicule, Date)")
+                    con.execute(f"CREATE INDEX IF NOT EXISTS idx_{key}_km ON {key} (Vehicule, Kilometrage)")
+                con.execute("CREATE TABLE IF NOT EXISTS config (name TEXT PRIMARY KEY, data TEXT)")
+                con.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, rev INTEGER)")
+                con.executemany("INSERT OR IGNORE INTO meta VALUES (?, 0)", [(k,) for k in [*COLUMNS, "config"]])
+                if fresh: self._migrate(con)
+                elif con.execute("SELECT 1 FROM meta WHERE name = 'config_file'").fetchone() is None:
+                    # Base créée avant le miroir : le JSON (peut-être retouché depuis) complète la table
+                    data = {n: json.loads(d) for n, d in con.execute("SELECT name, data FROM config ORDER BY rowid")}
+                    data.update(CsvStorage().read_config())
+                    self._write_config(con, data)
+                    self._write_config_file(con, json.dumps(data, indent=4))
+
+    def _connect(self):
+        con = sqlite3.connect(self.path, timeout=30)
+        con.execute("PRAGMA synchronous=NORMAL")
+        con.execute("PRAGMA cache_size=-65536") # 64 Mo : évite de déverser les grosses transactions dans le WAL
+        return con
+
+    def _migrate(self, con):
+        """Import unique des CSV/JSON existants à la création de la base"""
+        legacy = CsvStorage()
+        for key in COLUMNS:
+            if os.path.exists(FILES[key]): self._insert(con, key, legacy.read(key))
+        self._write_config(con, legacy.read_config())
+        self._note_config_file(con)
+
+    def _bump(self, con, key): con.execute("UPDATE meta SET rev = rev + 1 WHERE name = ?", (key,))
+
+    def _insert(self, con, key, rows):
+        cols = COLUMNS[key]
+        rows = rows.reindex(columns=cols)
+        out = rows.astype(object)
+        out['Date'] = pd.to_datetime(rows['Date'], errors='coerce').dt.strftime("%Y-%m-%d")
+        for c in cols[1:]:
+            if rows[c].dtype == object: out[c] = rows[c].map(lambda v: v.item() if hasattr(v, "item") else v)
+        con.executemany(f"INSERT INTO {key} ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})", out.where(out.notna(), None).itertuples(index=False, name=None))
+        # Dans une même transaction d'écriture, SQLite attribue des id consécutifs
+        last = con.execute(f"SELECT max(id) FROM {key}").fetchone()[0] or 0
+        self._bump(con, key)
+        return list(range(last - len(rows) + 1, last + 1))
+
+    def signature(self, key):
+        with closing(self._connect()) as con:
+            if key == "config": self._sync_config_file(con)
+            return ("sqlite", con.execute("SELECT rev FROM meta WHERE name = ?", (key,)).fetchone()[0])
+
+    def read(self, key, car=None):
+        sql = f"SELECT id, {', '.join(COLUMNS[key])} FROM {key}" + (" WHERE Vehicule = ?" if car is not None else "") + " ORDER BY id"
+        with closing(self._connect()) as con:
+            df = pd.read_sql_query(sql, con, params=(car,) if car is not None else (), index_col="id")
+        df.index.name = None
+        return _normalize(df, key)
+
+    def write(self, df, key):
+        with closing(self._connect()) as con, con:
+            con.execute(f"DELETE FROM {key}")
+            return pd.Index(self._insert(con, key, df))
+
+    def insert(self, key, rows):
+        with closing(self._connect()) as con, con: return self._insert(con, key, rows)
+
+    def update(self, key, changes):
+        with closing(self._connect()) as con, con:
+            # Regroupé par jeu de colonnes modifiées : un executemany par forme d'UPDATE
+            groups = {}
+            for row_id, values in changes.items():
+                cols = tuple(c for c in values if c in COLUMNS[key])
+                if cols: groups.setdefault(cols, []).append([_sql_value(values[c]) for c in cols] + [int(row_id)])
+            for cols, params in groups.items():
+                con.executemany(f"UPDATE {key} SET {', '.join(f'{c} = ?' for c in cols)} WHERE id = ?", params)
+            self._bump(con, key)
+
+    def delete(self, key, ids=None, car=None):
+        with closing(self._connect()) as con, con:
+            if ids: con.executemany(f"DELETE FROM {key} WHERE id = ?", [(int(i),) for i in ids])
+            if car is not None: con.execute(f"DELETE FROM {key} WHERE Vehicule = ?", (car,))
+            self._bump(con, key)
+
+    def bulk_insert(self, key, chunks):
+        """Tous les lots dans une seule transaction : tout ou rien"""
+        n = 0
+        with closing(self._connect()) as con, con:
+            for rows in chunks: n += len(self._insert(con, key, rows))
+        return n
+
+    def vehicles_of(self, key, ids):
+        ids, found = [int(i) for i in ids], set()
+        with closing(self._connect()) as con:
+            for n in range(0, len(ids), 900):
+                chunk = ids[n:n + 900]
+                found.update(r[0] for r in con.execute(f"SELECT DISTINCT Vehicule FROM {key} WHERE id IN ({', '.join('?' * len(chunk))})", chunk))
+        return list(found)
+
+    def read_config(self):
+        with closing(self._connect()) as con:
+            return {name: json.loads(data) for name, data in con.execute("SELECT name, data FROM config ORDER BY rowid")}
+
+    def _write_config(self, con, data):
+        con.executemany("INSERT INTO config VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET data = excluded.data WHERE data != excluded.data", [(k, json.dumps(v)) for k, v in data.items()])
+        con.execute(f"DELETE FROM config WHERE name NOT IN ({', '.join('?' * len(data))})", list(data))
+        self._bump(con, "config")
+
+    def _note_config_file(self, con):
+        if os.path.exists(FILES["config"]):
+            con.execute("INSERT OR REPLACE INTO meta VALUES ('config_file', ?)", (os.stat(FILES["config"]).st_mtime_ns,))
+
+    def _write_config_file(self, con, text):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(FILES["config"])), suffix=".tmp")
+        with os.fdopen(fd, "w") as f: f.write(text)
+        os.replace(tmp, FILES["config"])
+        self._note_config_file(con)
+
+    def _sync_config_file(self, con):
+        """Réimporte garage_config.json s'il a été modifié hors de l'appli (un JSON invalide est ignoré)"""
+        if not os.path.exists(FILES["config"]): return
+        row = con.execute("SELECT rev FROM meta WHERE name = 'config_file'").fetchone()
+        if row and row[0] == os.stat(FILES["config"]).st_mtime_ns: return
+        data = CsvStorage().read_config()
+        if not data: return
+        with con:
+            self._write_config(con, data)
+            self._note_config_file(con)
+
+    def write_config(self, data, text):
+        with closing(self._connect()) as con, con:
+            self._write_config(con, data)
+            self._write_config_file(con, text)
+
+@st.cache_resource
+def get_storage():
+    return CsvStorage() if STORAGE == "csv" else SqliteStorage(FILES["db"])
+
+def load_config():
+    """Config fusionnée avec DATA_INIT, relue seulement si le stockage a changé"""
+    store = get_storage()
+    sig = store.signature("config")
+    text = cache_get("config", sig)
+    if text is not None: return json.loads(text)
+    data = store.read_config()
     updated = False
     for car_key, car_info in DATA_INIT.items():
-        found = False
-        for k in data.keys():
-            if k == car_key or k == f"Voiture - {car_key}":
-                found = True
-                if "Moteur" in data[k] and data[k]["Moteur"] != car_info["Moteur"]:
-                    data[k].update(car_info); updated = True
-                break
-        if not found: data[car_key] = car_info; updated = True
+        k = car_key if car_key in data else f"Voiture - {car_key}"
+        if k in data:
+            if "Moteur" in data[k] and data[k]["Moteur"] != car_info["Moteur"]:
+                data[k].update(car_info); updated = True
+        else: data[car_key] = car_info; updated = True
     if updated: save_config(data)
+    else: cache_put("config", sig, json.dumps(data, indent=4))
     return data
 
 def save_config(data):
-    with open(FILES["config"], "w") as f: json.dump(data, f, indent=4)
+    """N'écrit la config que si son contenu a réellement changé"""
+    store = get_storage()
+    text = json.dumps(data, indent=4)
+    if cache_get("config", store.signature("config")) == text: return False
+    store.write_config(data, text)
+    cache_put("config", store.signature("config"), text)
+    return True
 
-def load_data(key):
-    path = FILES[key]
-    cols = ['Date', 'Vehicule', 'Kilometrage', 'Description', 'Cout', 'Facture'] if key == "maintenance" else ['Date', 'Vehicule', 'Kilometrage', 'Litres', 'Prix_Total', 'Conso_Calc']
-    try:
-        df = pd.read_csv(path)
-        df['Date'] = pd.to_datetime(df['Date'], errors='coerce')
-        for c in cols:
-            if c not in df.columns: df[c] = None
-        if key == "maintenance": df['Facture'] = df['Facture'].astype(str).replace('nan', None)
-        return df
-    except FileNotFoundError: return pd.DataFrame(columns=cols)
+def load_data(key, car=None):
+    """Table complète (une lecture par version du stockage) ou lignes d'un seul véhicule"""
+    store = get_storage()
+    if car is not None and store.indexed: return store.read(key, car)
+    sig = store.signature(key)
+    df = cache_get(key, sig)
+    if df is None:
+        df = store.read(key)
+        cache_put(key, sig, df)
+    return df.copy() if car is None else df[df['Vehicule'] == car].copy()
+
+def save_data(df, key):
+    """Réécriture complète d'une table (imports, outils) ; l'appli passe par les fonctions ligne à ligne"""
+    store = get_storage()
+    df = _normalize(df.copy(), key)
+    df.index = store.write(df, key)
+    # Write-through : le prochain load_data ne relit pas le stockage
+    cache_put(key, store.signature(key), df)
+
+def insert_rows(key, rows):
+    """Ajoute des lignes (liste de dicts ou DataFrame) et renvoie leurs identifiants"""
+    rows = pd.DataFrame(rows)
+    return _write(key, rows['Vehicule'].dropna().unique(), lambda store: store.insert(key, rows))
+
+def update_rows(key, changes):
+    """changes = {id: {colonne: valeur}}"""
+    if not changes: return
+    cars = {v['Vehicule'] for v in changes.values() if v.get('Vehicule')}
+    _write(key, cars, lambda store: store.update(key, changes), ids=list(changes))
+
+def delete_rows(key, ids=None, car=None):
+    _write(key, [car] if car is not None else [], lambda store: store.delete(key, ids=ids, car=car), ids=ids)
+
+# --- Sauvegarde des data_editor : patch (modifs / ajouts / suppressions) avec contrôle optimiste ---
+def editor_base(state_key, car, rows):
+    """Lignes affichées dans le data_editor, figées tant qu'il reste des modifications non sauvegardées
+    (un data_editor dynamique repart de zéro dès que ses données changent)"""
+    state = st.session_state.get(state_key) or {}
+    pending = any(state.get(k) for k in ("edited_rows", "added_rows", "deleted_rows"))
+    base = st.session_state.get(state_key + "_base")
+    if base is None or base["car"] != car or not pending:
+        base = st.session_state[state_key + "_base"] = {"car": car, "rows": rows}
+    return base
+
+def editor_values(values, key):
+    """Cellules saisies (JSON du data_editor) -> types de la table ; colonnes calculées ignorées"""
+    out = {}
+    for col, v in values.items():
+        if col not in COLUMNS[key] or col == 'Vehicule': continue
+        if col == 'Date': v = pd.to_datetime(v, errors='coerce')
+        elif col not in ('Description', 'Facture') and v is not None: v = pd.to_numeric(v, errors='coerce')
+        out[col] = v
+    return out
+
+def editor_patch(state, rows, key, car):
+    """Change set du data_editor (positions dans `rows`) -> (modifs {id: {col: val}}, ajouts, ids supprimés)"""
+    ids = rows.index
+    deleted = [ids[int(p)] for p in state.get("deleted_rows", [])]
+    edited = {ids[int(p)]: editor_values(v, key) for p, v in state.get("edited_rows", {}).items()}
+    edited = {i: v for i, v in edited.items() if v and i not in deleted}
+    added = [dict(editor_values(v, key), Vehicule=car) for v in state.get("added_rows", []) if v]
+    return edited, added, deleted
+
+def patch_since(rows, edited, added, deleted):
+    """Date la plus ancienne touchée par un patch (avant et après modification) : début du recalcul des consos"""
+    dates = [rows.at[i, 'Date'] for i in [*edited, *deleted]] + [v['Date'] for v in edited.values() if 'Date' in v] + [r.get('Date') for r in added]
+    dates = [d for d in dates if pd.notna(d)]
+    return min(dates) if dates else None
+
+def _same(a, b):
+    na, nb = pd.isna(a), pd.isna(b)
+    return (na and nb) if (na or nb) else a == b
+
+def apply_patch(key, car, base, edited, added, deleted):
+    """Écrit le patch si les lignes qu'il modifie ou supprime sont encore identiques à `base` ; sinon n'écrit rien
+    et renvoie les ids en conflit. Une écriture sur un autre véhicule ou une autre ligne n'est pas un conflit"""
+    rows = base["rows"]
+    cols = [c for c in COLUMNS[key] if c != 'Conso_Calc'] # Conso recalculée après chaque plein : pas une modif utilisateur
+    def fn(store):
+        current = store.read(key, car)
+        conflicts = [i for i in [*edited, *deleted] if i not in current.index or not all(_same(current.at[i, c], rows.at[i, c]) for c in cols)]
+        if conflicts: return conflicts
+        if edited: store.update(key, edited)
+        if added: store.insert(key, pd.DataFrame(added))
+        if deleted: store.delete(key, ids=deleted)
+        return []
+    if not (edited or added or deleted): return []
+    return _write(key, [car], fn)
+
+def list_vehicles(key):
+    """Véhicules présents dans une table, lus dans l'index de flotte en cache (pas de relecture du stockage)"""
+    return list(fleet_index().parts[key])
+
+# --- Index de flotte : partitions par véhicule + synthèse KPI matérialisée ---
+def _facture_mask(s): return s.notna() & ~s.astype(str).isin(["", "None", "nan"])
+
+def summarize(maint, fuel):
+    """KPI par véhicule (vectorisé) ; sert au calcul initial comme au rafraîchissement d'un seul véhicule"""
+    g = maint.groupby('Vehicule')
+    ok = fuel[fuel['Conso_Calc'] > 0]
+    # Dernière vidange : même reconnaissance que la règle "Vidange" (exclut vidange de boîte / de pont)
+    vid = maint[maint['Description'].isin([d for d, r in match_rules(maint['Description']).items() if "Vidange" in r])]
+    summary = pd.DataFrame({
+        "Km": g['Kilometrage'].max(),
+        "Total": g['Cout'].sum(),
+        "Conso": ok.groupby('Vehicule')['Conso_Calc'].mean(),
+        "Vidange_Km": vid.groupby('Vehicule')['Kilometrage'].max(),
+        "Factures": _facture_mask(maint['Facture']).groupby(maint['Vehicule']).sum(),
+    })
+    summary.index.name = None
+    return summary
+
+class FleetIndex:
+    """Lignes de chaque véhicule (partitions groupby) et tableau de synthèse, tenus à jour véhicule par véhicule"""
+
+    def __init__(self, maint, fuel):
+        self.parts = {
+            "maintenance": dict(tuple(maint.groupby('Vehicule', sort=False))),
+            "carburant": dict(tuple(fuel.groupby('Vehicule', sort=False))),
+        }
+        self.summary = summarize(maint, fuel)
+        self._text = None
+
+    def text(self):
+        """Index plein texte des descriptions, construit à la première recherche"""
+        if self._text is None:
+            with _shared_cache()["write_lock"]: # Pas de refresh concurrent pendant la construction
+                if self._text is None: self._text = TextIndex(self.parts["maintenance"])
+        return self._text
+
+    def rows(self, key, car):
+        part = self.parts[key].get(car)
+        return part.copy() if part is not None else _empty(key)
+
+    def frame(self, key):
+        parts = self.parts[key]
+        return pd.concat(parts.values()) if parts else _empty(key)
+
+    def kpi(self, car):
+        return self.summary.loc[car].to_dict() if car in self.summary.index else {"Km": None, "Total": 0, "Conso": None, "Vidange_Km": None, "Factures": 0}
+
+    def refresh(self, key, car, rows):
+        """Remplace les lignes d'un véhicule puis recalcule sa seule ligne de synthèse : O(lignes du véhicule)"""
+        if rows.empty: self.parts[key].pop(car, None)
+        else: self.parts[key][car] = rows
+        if key == "maintenance" and self._text is not None: self._text.refresh(car, rows)
+        maint, fuel = self.rows("maintenance", car), self.rows("carburant", car)
+        self.summary = pd.concat([self.summary.drop(index=car, errors='ignore'), summarize(maint, fuel)])
+
+def _fleet_sig(store): return (store.signature("maintenance"), store.signature("carburant"))
+
+def fleet_index():
+    store = get_storage()
+    sig = _fleet_sig(store)
+    idx = cache_get("fleet", sig)
+    if idx is None:
+        idx = FleetIndex(load_data("maintenance"), load_data("carburant"))
+        cache_put("fleet", sig, idx)
+    return idx
+
+def _write(key, cars, fn, ids=None):
+    """Écriture + mise à jour incrémentale de l'index de flotte pour les seuls véhicules touchés"""
+    store = get_storage()
+    with _shared_cache()["write_lock"]:
+        idx = cache_get("fleet", _fleet_sig(store))
+        cars = set(cars) | (set(store.vehicles_of(key, ids)) if ids and idx is not None else set())
+        result = fn(store)
+        # Le backend CSV réécrit tout le fichier : l'index sera simplement reconstruit
+        if idx is not None and store.indexed:
+            for car in cars: idx.refresh(key, car, store.read(key, car))
+            cache_put("fleet", _fleet_sig(store), idx)
+    return result
+
+# --- Moteur de consommation (L/100 calculé sur tout l'historique en une passe) ---
+CONSO_MIN, CONSO_MAX = 2.0, 30.0 # Hors de ces bornes : plein partiel ou erreur de compteur
+CONSO_WINDOW = 5
+
+def compute_conso(fuel):
+    """Conso de chaque plein = Litres / distance depuis le plein précédent du même véhicule.
+    Tri véhicule + date + km, diff par groupe ; retours de compteur et valeurs aberrantes -> 0"""
+    codes = pd.factorize(fuel['Vehicule'])[0]
+    dates = pd.to_datetime(fuel['Date'], errors='coerce').to_numpy('datetime64[ns]').astype('int64')
+    km = pd.to_numeric(fuel['Kilometrage'], errors='coerce').to_numpy(float)
+    litres = pd.to_numeric(fuel['Litres'], errors='coerce').to_numpy(float)
+    order = np.lexsort((km, dates, codes))
+    c, k = codes[order], km[order]
+    same = np.r_[False, c[1:] == c[:-1]] & (c >= 0)
+    dist = np.r_[np.nan, np.diff(k)]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        conso = litres[order] / dist * 100
+    ok = same & (dist > 0) & (conso >= CONSO_MIN) & (conso <= CONSO_MAX)
+    out = np.empty(len(order))
+    out[order] = np.where(ok, np.round(conso, 2), 0.0)
+    return pd.Series(out, index=fuel.index, name='Conso_Calc')
 
-def save_data(df, key): df.to_csv(FILES[key], index=False)
+def _conso_changes(fuel, conso):
+    old = pd.to_numeric(fuel['Conso_Calc'], errors='coerce').fillna(0).round(2)
+    diff = conso[old != conso]
+    return {i: {'Conso_Calc': v} for i, v in diff.items()}
+
+def refresh_conso(car, since=None):
+    """Recalcule la conso d'un véhicule à partir de `since` (le plein précédent sert de référence)"""
+    fuel = fleet_index().rows("carburant", car)
+    if fuel.empty: return 0
+    fuel = fuel.sort_values(['Date', 'Kilometrage'], kind='stable')
+    if since is not None:
+        start = max(int((fuel['Date'] < pd.Timestamp(since)).sum()) - 1, 0)
+        fuel = fuel.iloc[start:]
+    conso = compute_conso(fuel)
+    if since is not None: conso = conso.iloc[1:] if start > 0 else conso
+    changes = _conso_changes(fuel.loc[conso.index], conso)
+    update_rows("carburant", changes)
+    return len(changes)
+
+def recompute_all_conso():
+    """Recalcul complet de la flotte ; seules les lignes dont la valeur change sont écrites"""
+    fuel = load_data("carburant")
+    changes = _conso_changes(fuel, compute_conso(fuel))
+    update_rows("carburant", changes)
+    return len(changes)
+
+def parse_conso_th(value):
+    m = re.match(r"\s*(\d+(?:[.,]\d+)?)", str(value or ""))
+    return float(m.group(1).replace(",", ".")) if m else None
+
+def conso_stats(fuel, config):
+    """Par véhicule : médiane, moyenne glissante des derniers pleins valides, théorique (Conso_Th) et écart"""
+    ok = fuel[fuel['Conso_Calc'] > 0].sort_values(['Vehicule', 'Date', 'Kilometrage'])
+    g = ok.groupby('Vehicule')['Conso_Calc']
+    stats = pd.DataFrame({
+        "Mediane": g.median(),
+        "Glissante": ok.groupby('Vehicule').tail(CONSO_WINDOW).groupby('Vehicule')['Conso_Calc'].mean(),
+    })
+    stats["Theorique"] = [parse_conso_th(config.get(car, {}).get("Conso_Th")) for car in stats.index]
+    stats["Ecart_%"] = (stats["Glissante"] / stats["Theorique"] - 1) * 100
+    stats.index.name = None
+    return stats
+
+# --- Import en masse (historiques atelier, exports carte carburant) ---
+IMPORT_CHUNK = 50_000
+IMPORT_ALIASES = {
+    "Date": ["date", "datetransaction", "dateintervention", "jour"],
+    "Vehicule": ["vehicule", "voiture", "nom", "plaque", "immatriculation", "immat"],
+    "Kilometrage": ["kilometrage", "km", "kms", "compteur"],
+    "Description": ["description", "libelle", "intervention", "designation", "operation"],
+    "Cout": ["cout", "prix", "montant", "montantttc", "ttc", "total"],
+    "Facture": ["facture"],
+    "Litres": ["litres", "litre", "quantite", "qte", "volume"],
+    "Prix_Total": ["prixtotal", "montant", "montantttc", "ttc", "total", "prix"],
+    "Conso_Calc": ["consocalc"],
+}
+DEDUP_KEY = {"maintenance": ['Vehicule', 'Date', 'Kilometrage', 'Description'], "carburant": ['Vehicule', 'Date', 'Kilometrage', 'Litres']}
+
+def _norm_key(value):
+    value = unicodedata.normalize("NFKD", str(value)).encode("ascii", "ignore").decode()
+    return re.sub(r"[^a-z0-9]", "", value.lower())
+
+def _vehicle_lookup(config):
+    """Nom, nom sans 'Voiture - ' ou plaque (normalisés) -> clé de garage_config"""
+    lut = {}
+    for name, info in config.items():
+        if name.startswith("_"): continue
+        plate = _norm_key(info.get("Plaque", ""))
+        if plate: lut[plate] = name
+    for name in (n for n in config if not n.startswith("_")):
+        lut[_norm_key(name.replace("Voiture - ", ""))] = name
+        lut[_norm_key(name)] = name
+    return lut
+
+def _parse_dates(s):
+    d = pd.to_datetime(s, format="ISO8601", errors='coerce')
+    rest = d.isna() & s.notna()
+    if rest.any(): d[rest] = pd.to_datetime(s[rest], dayfirst=True, format="mixed", errors='coerce')
+    return d
+
+def _parse_numbers(s):
+    if pd.api.types.is_numeric_dtype(s): return s
+    s = s.astype(str).str.replace("[\\s\xa0€]", "", regex=True).str.replace(",", ".", regex=False)
+    return pd.to_numeric(s, errors='coerce')
+
+def _dedup_hash(df, key):
+    """Empreinte 64 bits de la clé de doublon, indépendante des dtypes (int/float, unité des dates)"""
+    parts = {}
+    for c in DEDUP_KEY[key]:
+        if c == 'Date': parts[c] = df[c].dt.strftime("%Y-%m-%d").fillna("")
+        elif c in ('Vehicule', 'Description'): parts[c] = df[c].fillna("").astype(str).str.strip()
+        else: parts[c] = pd.to_numeric(df[c], errors='coerce').astype(float).round(3)
+    return pd.util.hash_pandas_object(pd.DataFrame(parts), index=False).to_numpy()
+
+def _sniff(src):
+    """Séparateur (',' ou ';') et encodage (UTF-8, sinon Windows-1252 des exports bancaires)"""
+    if isinstance(src, (str, os.PathLike)):
+        with open(src, "rb") as f: head = f.read(1 << 16)
+    else:
+        src.seek(0); head = src.read(1 << 16); src.seek(0)
+    try: head.decode("utf-8"); encoding = "utf-8-sig"
+    except UnicodeDecodeError as e: encoding = "utf-8-sig" if e.start > len(head) - 4 else "cp1252"
+    first = head.split(b"\n", 1)[0]
+    return (";" if first.count(b";") > first.count(b",") else ","), encoding
+
+def bulk_import(src, key, config, chunksize=IMPORT_CHUNK):
+    """Importe un CSV (chemin ou fichier uploadé) par lots : normalisation, rattachement des véhicules,
+    dédoublonnage puis un seul commit. Les lignes rejetées vont dans un rapport CSV."""
+    cols = COLUMNS[key]
+    lut = _vehicle_lookup(config)
+    new_cars = {}
+    seen = _dedup_hash(load_data(key), key)
+    os.makedirs(os.path.join(CACHE_DIR, "imports"), exist_ok=True)
+    stats = {"lues": 0, "importees": 0, "doublons": 0, "rejets": 0, "nouveaux": [], "rapport": None}
+
+    def chunks():
+        nonlocal seen
+        sep, encoding = _sniff(src)
+        reader = pd.read_csv(src, sep=sep, chunksize=chunksize, dtype=str, encoding=encoding, encoding_errors="replace")
+        for raw in reader:
+            stats["lues"] += len(raw)
+            mapping = {}
+            for c in raw.columns:
+                for target in cols:
+                    if target not in mapping.values() and _norm_key(c) in IMPORT_ALIASES[target]: mapping[c] = target; break
+            raw = raw.rename(columns=mapping)
+            df = pd.DataFrame({c: raw[c] if c in raw.columns else None for c in cols}, index=raw.index)
+            df['Date'] = _parse_dates(df['Date'])
+            for c in cols:
+                if c not in ('Date', 'Vehicule', 'Description', 'Facture'): df[c] = _parse_numbers(df[c])
+
+            veh_raw = df['Vehicule'].fillna("").astype(str).str.strip()
+            veh_key = veh_raw.map({v: _norm_key(v) for v in veh_raw.unique()})
+            reason = pd.Series(None, index=df.index, dtype=object)
+            if key == "carburant": reason[df['Litres'].isna()] = "litres invalides"
+            reason[df['Kilometrage'].isna()] = "kilométrage invalide"
+            reason[df['Date'].isna()] = "date invalide"
+            reason[veh_key == ""] = "véhicule manquant"
+            bad = reason.notna()
+            if bad.any():
+                rej = raw[bad].assign(Ligne=raw.index[bad] + 2, Motif=reason[bad])
+                if stats["rapport"] is None:
+                    # Nom unique : deux imports dans la même seconde n'écrivent pas dans le même rapport
+                    fd, stats["rapport"] = tempfile.mkstemp(dir=os.path.join(CACHE_DIR, "imports"), prefix=f"rejets_{key}_{datetime.now():%Y%m%d_%H%M%S}_", suffix=".csv")
+                    with os.fdopen(fd, "w", encoding="utf-8", newline="") as f: rej.to_csv(f, index=False)
+                else: rej.to_csv(stats["rapport"], mode='a', header=False, index=False)
+                stats["rejets"] += int(bad.sum())
+
+            # Véhicules inconnus : créés comme en section 4 pour les noms trouvés dans le CSV
+            named = pd.DataFrame({"k": veh_key, "name": veh_raw})[~bad].drop_duplicates("k")
+            for k, name in zip(named["k"], named["name"]):
+                if k not in lut:
+                    lut[k] = name
+                    is_plate = re.fullmatch(r"[A-Za-z]{2}-?\d{3}-?[A-Za-z]{2}", name) is not None
+                    new_cars[name] = {"Marque": "Inconnu", "Modele": "-", "Plaque": name if is_plate else "-", "Moteur": "-", "Huile": "-", "Conso_Th": "-"}
+            df['Vehicule'] = veh_key.map(lut)
+            df = df[~bad]
+            if key == "maintenance": df['Cout'] = df['Cout'].fillna(0)
+
+            h = _dedup_hash(df, key)
+            dup = np.isin(h, seen) | pd.Series(h).duplicated().to_numpy()
+            stats["doublons"] += int(dup.sum())
+            seen = np.concatenate([seen, h[~dup]])
+            yield df[~dup]
+
+    with _shared_cache()["write_lock"]:
+        stats["importees"] = get_storage().bulk_insert(key, chunks())
+    if new_cars:
+        config.update(new_cars); save_config(config)
+        stats["nouveaux"] = sorted(new_cars)
+    if key == "carburant" and stats["importees"]: recompute_all_conso()
+    return stats
+
+# --- Règles d'entretien (toute la flotte en une passe) ---
+# Intervalles surchargés dans garage_config.json, par véhicule : "Intervalles": {"Vidange": 10000}
+# ou par moteur via l'entrée réservée "_Regles": {"Moteurs": {"HDi": {"Vidange": {"km": 20000, "marge": 2000}}}}
+# (en SQLite, le JSON modifié à la main est réimporté dans la table config : voir SqliteStorage)
+RULES_KEY = "_Regles"
+MAINT_RULES = {
+    "Huile de boîte": {"motif": r"(?:vidange|huile)\s+(?:de\s+)?(?:la\s+)?boite", "km": 60000, "marge": 10000},
+    "Vidange": {"motif": r"vidange(?!\s+(?:de\s+)?(?:la\s+|du\s+)?(?:boite|pont))|huile\s+moteur", "km": 15000, "marge": 3000},
+    "Courroie distribution": {"motif": r"courroie\s+(?:de\s+)?distri", "km": 120000, "marge": 10000},
+    "Plaquettes de frein": {"motif": r"plaquette", "km": 30000, "marge": 5000},
+    "Filtres": {"motif": r"filtre", "km": 30000, "marge": 5000},
+}
+RULE_NAMES = list(MAINT_RULES)
+RULES_RE = re.compile("|".join(f"(?P<r{i}>{r['motif']})" for i, r in enumerate(MAINT_RULES.values())))
+
+def fold_text(value):
+    """Minuscules sans accents : 'Boîte' -> 'boite'"""
+    return unicodedata.normalize("NFKD", str(value)).encode("ascii", "ignore").decode().lower()
+
+def tokenize(value):
+    """Mots repliés : 'Filtre à gazole' -> ['filtre', 'a', 'gazole']"""
+    return re.findall(r"[a-z0-9]+", fold_text(value))
+
+def match_rules(descriptions):
+    """Description -> règles reconnues ; la regex combinée ne passe qu'une fois sur chaque description distincte"""
+    return {d: list(dict.fromkeys(RULE_NAMES[int(m.lastgroup[1:])] for m in RULES_RE.finditer(fold_text(d)))) for d in descriptions.dropna().unique()}
+
+def rule_intervals(config):
+    """(Véhicule, Règle) -> intervalle et marge : défaut, puis surcharge moteur, puis surcharge véhicule"""
+    engines = config.get(RULES_KEY, {}).get("Moteurs", {})
+    rows = []
+    for car, info in config.items():
+        if car.startswith("_"): continue
+        moteur = str(info.get("Moteur", "")).lower()
+        overrides = [o for motif, o in engines.items() if motif.lower() in moteur] + [info.get("Intervalles", {})]
+        for name, rule in MAINT_RULES.items():
+            km, marge = rule["km"], rule["marge"]
+            for o in overrides:
+                v = o.get(name)
+                if isinstance(v, dict): km, marge = v.get("km", km), v.get("marge", marge)
+                elif v: km = v
+            rows.append((car, name, km, marge))
+    return pd.DataFrame(rows, columns=['Vehicule', 'Regle', 'Intervalle', 'Marge']).set_index(['Vehicule', 'Regle'])
+
+def evaluate_rules(maint, fuel, config):
+    """Statut de chaque (véhicule, règle) : dernier km de l'intervention vs km actuel (entretien + pleins)"""
+    rules = maint['Description'].map(match_rules(maint['Description']))
+    hits = maint[['Vehicule', 'Kilometrage', 'Date']].assign(Regle=rules).explode('Regle').dropna(subset=['Regle'])
+    last = hits.groupby(['Vehicule', 'Regle']).agg(Dernier_Km=('Kilometrage', 'max'), Derniere_Date=('Date', 'max'))
+    km_now = pd.concat([maint[['Vehicule', 'Kilometrage']], fuel[['Vehicule', 'Kilometrage']]]).groupby('Vehicule')['Kilometrage'].max()
+    res = rule_intervals(config).join(last, how='left').reset_index()
+    res['Km_Actuel'] = res['Vehicule'].map(km_now).fillna(0)
+    res['Ecart'] = res['Km_Actuel'] - res['Dernier_Km']
+    res['Statut'] = np.select(
+        [res['Dernier_Km'].isna(), res['Ecart'] > res['Intervalle'], res['Ecart'] > res['Intervalle'] - res['Marge']],
+        ["aucun historique", "urgent", "a prevoir"], "ok")
+    return res
+
+def fleet_alerts(config):
+    """evaluate_rules sur toute la flotte, gardé en cache tant que données et config ne changent pas"""
+    store = get_storage()
+    sig = (_fleet_sig(store), store.signature("config"))
+    res = cache_get("alerts", sig)
+    if res is None:
+        fleet = fleet_index()
+        res = evaluate_rules(fleet.frame("maintenance"), fleet.frame("carburant"), config)
+        cache_put("alerts", sig, res)
+    return res
+
+# --- Recherche plein texte dans les descriptions d'entretien ---
+TEXT_LIMIT = 200 # Lignes renvoyées (les plus récentes) ; le total est compté à part
+
+def edit_within(a, b, k):
+    """Distance de Levenshtein(a, b) <= k, en abandonnant dès qu'une ligne dépasse k"""
+    if abs(len(a) - len(b)) > k: return False
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1): cur.append(min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb)))
+        if min(cur) > k: return False
+        prev = cur
+    return prev[-1] <= k
+
+def _typos(n): return 0 if n < 4 else 1 if n < 7 else 2
+
+class TextIndex:
+    """Index inversé mot replié -> {véhicule: positions des lignes}, mis à jour véhicule par véhicule"""
+    COLUMNS = ['Vehicule', 'Date', 'Kilometrage', 'Description', 'Cout']
+
+    def __init__(self, parts):
+        self.lock = threading.Lock()
+        self.postings, self.terms_of, self.cols = {}, {}, {}
+        self.descs, self.desc_code, self.desc_terms = [], {}, [] # Descriptions distinctes, découpées une seule fois
+        self._vocab, self._expand = None, {}
+        self._add(parts)
+
+    def _codes(self, descriptions):
+        codes, uniques = pd.factorize(descriptions.fillna(""), sort=False)
+        glob = np.empty(len(uniques), np.int64)
+        for i, d in enumerate(uniques):
+            g = self.desc_code.get(d)
+            if g is None:
+                g = self.desc_code[d] = len(self.descs)
+                self.descs.append(d); self.desc_terms.append(tuple(dict.fromkeys(tokenize(d))))
+            glob[i] = g
+        return glob[codes]
+
+    def _add(self, parts):
+        cars = [car for car, rows in parts.items() if not rows.empty]
+        if not cars: return
+        sizes = np.array([len(parts[car]) for car in cars])
+        maint = pd.concat([parts[car] for car in cars]) if len(cars) > 1 else parts[cars[0]]
+        dcode = self._codes(maint['Description'])
+        date = maint['Date'].to_numpy('datetime64[ns]')
+        km = pd.to_numeric(maint['Kilometrage'], errors='coerce').to_numpy(float)
+        cost = pd.to_numeric(maint['Cout'], errors='coerce').to_numpy(float)
+        starts = np.r_[0, np.cumsum(sizes)]
+        for i, car in enumerate(cars):
+            sl = slice(starts[i], starts[i + 1])
+            self.cols[car] = {"desc": dcode[sl], "date": date[sl], "km": km[sl], "cout": cost[sl]}
+            self.terms_of[car] = set()
+        # Paires (ligne, mot) en une passe : chaque ligne répétée autant de fois que sa description a de mots
+        ud, inv = np.unique(dcode, return_inverse=True)
+        terms = sorted({t for d in ud for t in self.desc_terms[d]})
+        tid = {t: i for i, t in enumerate(terms)}
+        ntok = np.array([len(self.desc_terms[d]) for d in ud], dtype=np.int64)
+        flat = np.array([tid[t] for d in ud for t in self.desc_terms[d]], dtype=np.int64)
+        reps = ntok[inv]
+        row = np.repeat(np.arange(len(dcode)), reps)
+        if not len(row): return
+        within = np.arange(len(row)) - np.repeat(np.cumsum(reps) - reps, reps)
+        car_of = np.repeat(np.arange(len(cars)), sizes)[row]
+        key = flat[(np.cumsum(ntok) - ntok)[inv[row]] + within] * len(cars) + car_of
+        order = np.argsort(key, kind="stable") # Stable : positions croissantes dans chaque (mot, véhicule)
+        key, pos = key[order], (row - starts[car_of])[order]
+        bounds = np.r_[0, np.flatnonzero(np.diff(key)) + 1, len(key)]
+        for k, a, b in zip(key[bounds[:-1]].tolist(), bounds[:-1].tolist(), bounds[1:].tolist()):
+            term, car = terms[k // len(cars)], cars[k % len(cars)]
+            self.postings.setdefault(term, {})[car] = pos[a:b]
+            self.terms_of[car].add(term)
+        self._vocab, self._expand = None, {}
+
+    def _remove(self, car):
+        for term in self.terms_of.pop(car, ()):
+            posting = self.postings[term]
+            posting.pop(car, None)
+            if not posting: del self.postings[term]
+        self.cols.pop(car, None)
+        self._vocab, self._expand = None, {}
+
+    def refresh(self, car, rows):
+        with self.lock:
+            self._remove(car)
+            self._add({car: rows})
+
+    def expand(self, term):
+        """Mots indexés qui commencent par term, ou à 1-2 fautes près (même initiale, hors nombres)"""
+        if term in self._expand: return self._expand[term]
+        if self._vocab is None:
+            self._vocab = sorted(self.postings)
+            self._buckets = {}
+            for w in self._vocab: self._buckets.setdefault(w[0], []).append(w)
+        if len(term) < 2: found = {term} & self.postings.keys()
+        else:
+            i = bisect.bisect_left(self._vocab, term)
+            j = bisect.bisect_left(self._vocab, term + "\x7f")
+            found = set(self._vocab[i:j])
+        # Fautes tolérées selon le plus long des deux mots : 'gasoil' trouve 'gazoile' et réciproquement
+        if len(term) > 1 and not any(c.isdigit() for c in term):
+            found.update(w for w in self._buckets.get(term[0], ()) if w not in found and not any(c.isdigit() for c in w)
+                         and edit_within(term, w, _typos(max(len(term), len(w)))))
+        self._expand[term] = found
+        return found
+
+    def search(self, query, cars=None, dates=None, cost=None, limit=TEXT_LIMIT):
+        """(lignes les plus récentes contenant tous les termes, nombre total de lignes trouvées)"""
+        terms = tokenize(query or "")
+        records, total = [], 0
+        with self.lock:
+            # Un masque de lignes par véhicule : union des variantes d'un terme puis ET entre termes, sans tri
+            hits = None
+            for t in dict.fromkeys(terms):
+                masks = {}
+                for w in self.expand(t):
+                    for car, pos in self.postings[w].items():
+                        if (cars is not None and car not in cars) or (hits is not None and car not in hits): continue
+                        if car not in masks: masks[car] = np.zeros(len(self.cols[car]["desc"]), bool)
+                        masks[car][pos] = True
+                if hits is not None:
+                    for car, m in masks.items(): m &= hits[car]
+                hits = masks
+                if not hits: break
+            sel_car, sel_pos = [], []
+            if dates: lo, hi = np.datetime64(dates[0], 'ns'), np.datetime64(dates[1], 'ns') + np.timedelta64(1, 'D')
+            for car, mask in (hits or {}).items():
+                c = self.cols[car]
+                if dates: mask &= (c["date"] >= lo) & (c["date"] < hi)
+                if cost and cost[0] is not None: mask &= c["cout"] >= cost[0]
+                if cost and cost[1] is not None: mask &= c["cout"] <= cost[1]
+                pos = mask.nonzero()[0]
+                if len(pos): sel_car.append(car); sel_pos.append(pos)
+            total = sum(len(p) for p in sel_pos)
+            if total:
+                # Les `limit` plus récentes : sélection partielle puis tri, seules ces lignes sont matérialisées
+                which = np.repeat(np.arange(len(sel_car)), [len(p) for p in sel_pos])
+                pos_all = np.concatenate(sel_pos)
+                d = np.concatenate([self.cols[car]["date"][p] for car, p in zip(sel_car, sel_pos)])
+                neg = -np.where(np.isnat(d), np.iinfo(np.int64).min + 1, d.astype(np.int64)) # Dates inconnues en dernier
+                top = np.argpartition(neg, limit)[:limit] if total > limit else np.arange(total)
+                top = top[np.argsort(neg[top], kind="stable")]
+                for i, p in zip(which[top].tolist(), pos_all[top].tolist()):
+                    c = self.cols[sel_car[i]]
+                    records.append((sel_car[i], c["date"][p], c["km"][p], self.descs[c["desc"][p]], c["cout"][p]))
+        return pd.DataFrame(records, columns=self.COLUMNS).astype({'Date': 'datetime64[ns]'}), total
+
+def search_descriptions(query, cars=None, dates=None, cost=None, limit=TEXT_LIMIT):
+    return fleet_index().text().search(query, cars, dates, cost, limit)
+
+# --- Factures : stockage adressé par contenu (factures/<sha256>.<ext>), dédoublonné ---
+# "off", "lossless" (PNG réoptimisés) ou "lossy" (photos réduites à 2500 px, JPEG q85)
+INVOICE_COMPRESSION = os.environ.get("GARAGE_FACTURE_COMPRESSION", "lossless")
+BLOB_RE = re.compile(r"[0-9a-f]{64}\.[a-z0-9]+")
+
+def _blob_index():
+    con = sqlite3.connect(FILES["blobs"], timeout=30)
+    con.execute("CREATE TABLE IF NOT EXISTS blobs (source TEXT PRIMARY KEY, sha TEXT, path TEXT, name TEXT, size INTEGER, created TEXT)")
+    return con
+
+def _sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""): h.update(chunk)
+    return h.hexdigest()
+
+def _recompress(src, ext):
+    """Renvoie (fichier, extension) : la version recompressée si elle est plus petite, sinon l'original"""
+    if INVOICE_COMPRESSION == "off" or ext not in PHOTO_EXTS: return src, ext
+    if INVOICE_COMPRESSION == "lossless" and ext != ".png": return src, ext
+    try: img = ImageOps.exif_transpose(Image.open(src))
+    except Exception: return src, ext
+    fd, out = tempfile.mkstemp(dir="factures", suffix=".part")
+    with os.fdopen(fd, "wb") as f:
+        if INVOICE_COMPRESSION == "lossy":
+            img.thumbnail((2500, 2500), Image.Resampling.LANCZOS)
+            img.convert("RGB").save(f, "JPEG", quality=85, optimize=True); new_ext = ".jpg"
+        else: img.save(f, "PNG", optimize=True); new_ext = ".png"
+    if os.path.getsize(out) >= os.path.getsize(src):
+        os.remove(out); return src, ext
+    os.remove(src)
+    return out, new_ext
+
+def store_invoice(fileobj, name):
+    """Copie en flux (blocs de 1 Mo) + SHA-256 ; un contenu déjà connu n'est jamais stocké deux fois"""
+    ext = os.path.splitext(name)[1].lower() or ".bin"
+    fd, tmp = tempfile.mkstemp(dir="factures", suffix=".part")
+    h = hashlib.sha256()
+    with os.fdopen(fd, "wb") as f:
+        for chunk in iter(lambda: fileobj.read(1 << 20), b""): h.update(chunk); f.write(chunk)
+    source, now = h.hexdigest(), datetime.now().isoformat(timespec="seconds")
+    with closing(_blob_index()) as con, con:
+        known = con.execute("SELECT path FROM blobs WHERE source = ?", (source,)).fetchone()
+        if known and os.path.exists(known[0]):
+            # Rajeunit le fichier (gc_invoices épargne les fichiers récents) et retient le dernier nom envoyé
+            os.remove(tmp); os.utime(known[0])
+            con.execute("UPDATE blobs SET name = ?, created = ? WHERE source = ?", (name, now, source))
+            return known[0]
+        out, ext = _recompress(tmp, ext)
+        sha = source if out == tmp else _sha256_file(out)
+        path = os.path.join("factures", sha + ext)
+        if os.path.exists(path): os.remove(out); os.utime(path)
+        else: os.replace(out, path)
+        con.execute("INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?, ?, ?)", (source, sha, path, name, os.path.getsize(path), now))
+    return path
 
 def save_uploaded_file(uploaded_file):
     if uploaded_file is not None:
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"{timestamp}_{uploaded_file.name}"
-        path = os.path.join("factures", filename)
-        with open(path, "wb") as f: f.write(uploaded_file.getbuffer())
-        return path
+        uploaded_file.seek(0)
+        return store_invoice(uploaded_file, uploaded_file.name)
     return None
 
+def invoice_name(path):
+    """Nom d'origine du fichier (pour le téléchargement)"""
+    if BLOB_RE.fullmatch(os.path.basename(path)) and os.path.exists(FILES["blobs"]):
+        with closing(_blob_index()) as con:
+            row = con.execute("SELECT name FROM blobs WHERE path = ? ORDER BY created DESC", (path,)).fetchone()
+        if row: return row[0]
+    return os.path.basename(path)
+
+def _norm_path(path): return os.path.normpath(str(path).replace("\\", "/"))
+
+def invoice_refcounts():
+    """Chemin de facture -> nombre de lignes d'entretien qui la référencent"""
+    f = fleet_index().frame("maintenance")['Facture']
+    return f[_facture_mask(f)].map(_norm_path).value_counts()
+
+def gc_invoices(candidates=None, min_age=3600):
+    """Supprime les fichiers de factures/ qui ne sont plus référencés par aucune ligne.
+    Les fichiers récents (< min_age s) sont épargnés : leur ligne est peut-être en cours d'ajout."""
+    live = set(invoice_refcounts().index)
+    if candidates is None:
+        candidates = [e.path for e in os.scandir("factures") if e.is_file() and not e.name.startswith("index.sqlite")]
+    now = datetime.now().timestamp()
+    removed = []
+    for path in {_norm_path(p) for p in candidates if str(p) not in ("", "None", "nan")}:
+        try:
+            if path in live or now - os.path.getmtime(path) < min_age: continue
+            os.remove(path); removed.append(path)
+        except FileNotFoundError: continue
+    if removed and os.path.exists(FILES["blobs"]):
+        with closing(_blob_index()) as con, con:
+            con.executemany("DELETE FROM blobs WHERE path = ?", [(p,) for p in removed])
+    return removed
+
+def migrate_invoices():
+    """Passe les factures existantes (noms horodatés) dans le stockage adressé par contenu"""
+    maint = fleet_index().frame("maintenance")
+    refs = maint[_facture_mask(maint['Facture'])]
+    moved, changes = {}, {}
+    for row_id, path in refs['Facture'].items():
+        if BLOB_RE.fullmatch(os.path.basename(path)) or not os.path.exists(path): continue
+        if path not in moved:
+            with open(path, "rb") as f: moved[path] = store_invoice(f, os.path.basename(path).split("_", 2)[-1])
+        changes[row_id] = {'Facture': moved[path]}
+    update_rows("maintenance", changes)
+    gc_invoices(list(moved), min_age=0)
+    return len(changes)
+
 def load_and_crop_image(image_path, target_size=(400, 300)):
     try:
         img = Image.open(image_path)
@@ -84,121 +1072,210 @@ def load_and_crop_image(image_path, target_size=(400, 300)):
         return img
     except Exception: return None
 
+PHOTO_EXTS = ['.jpg', '.jpeg', '.png', '.webp']
+THUMB_LRU_SIZE = 256
+
+def photo_index():
+    """Index nom -> fichier de photos/, reconstruit par un seul scandir quand le dossier change"""
+    sig = file_signature("photos")
+    index = cache_get("photos", sig)
+    if index is None:
+        index = {}
+        with os.scandir("photos") as it:
+            for entry in it:
+                stem, ext = os.path.splitext(entry.name)
+                if entry.is_file() and ext in PHOTO_EXTS:
+                    prev = index.get(stem)
+                    if prev is None or PHOTO_EXTS.index(ext) < PHOTO_EXTS.index(os.path.splitext(prev)[1]): index[stem] = entry.path
+        cache_put("photos", sig, index)
+    return index
+
 def get_car_image_path(car_name):
+    index = photo_index()
     clean = car_name.replace("Voiture - ", "").strip()
-    candidates = [car_name, clean]
-    for c in candidates:
-        for ext in ['.jpg', '.jpeg', '.png', '.webp']:
-            path = os.path.join("photos", c + ext)
-            if os.path.exists(path): return path
+    for c in [car_name, clean]:
+        if c in index: return index[c]
     return None
 
-def generer_pdf_complet(car_name, df_car):
-    """Génère un PDF Récapitulatif + Fusionne les factures à la suite"""
-    
-    # 1. Création du PDF Récapitulatif (Tableau) avec FPDF
-    pdf_recap = FPDF()
-    pdf_recap.add_page()
-    pdf_recap.set_font("Arial", 'B', 16)
-    pdf_recap.cell(0, 10, f"Dossier Entretien - {car_name}", ln=True, align='C')
-    pdf_recap.ln(10)
-    pdf_recap.set_font("Arial", '', 12)
-    pdf_recap.cell(0, 10, f"Dossier genere le {datetime.now().strftime('%d/%m/%Y')}", ln=True)
-    pdf_recap.ln(5)
-    
-    # Tableau
-    pdf_recap.set_font("Arial", 'B', 10)
-    pdf_recap.cell(25, 10, "Date", 1)
-    pdf_recap.cell(25, 10, "Km", 1)
-    pdf_recap.cell(95, 10, "Description", 1)
-    pdf_recap.cell(25, 10, "Prix", 1)
-    pdf_recap.cell(20, 10, "PJ", 1)
-    pdf_recap.ln()
-    
-    pdf_recap.set_font("Arial", '', 9)
-    total = 0
-    factures_a_fusionner = []
-
-    for _, row in df_car.iterrows():
-        d = row['Date'].strftime('%d/%m/%Y') if pd.notna(row['Date']) else "-"
-        c = row['Cout'] if pd.notna(row['Cout']) else 0
-        total += c
-        
-        has_facture = "NON"
-        f_path = str(row['Facture'])
-        if f_path and f_path != "None" and f_path != "" and os.path.exists(f_path):
-            has_facture = "OUI"
-            # On mémorise la facture pour la fusionner plus tard
-            factures_a_fusionner.append((row['Description'], f_path))
-
-        pdf_recap.cell(25, 10, d, 1)
-        pdf_recap.cell(25, 10, str(row['Kilometrage']), 1)
-        pdf_recap.cell(95, 10, str(row['Description'])[:60], 1)
-        pdf_recap.cell(25, 10, f"{c:.0f} E", 1)
-        pdf_recap.cell(20, 10, has_facture, 1)
-        pdf_recap.ln()
-    
-    pdf_recap.ln(5)
-    pdf_recap.set_font("Arial", 'B', 12)
-    pdf_recap.cell(0, 10, f"TOTAL INVESTI : {total:,.2f} Euros", ln=True, align='R')
-    
-    # On sauvegarde le récapitulatif temporairement
-    temp_recap = "temp_recap.pdf"
-    pdf_recap.output(temp_recap)
-    
-    # 2. Fusion avec PyPDF
-    merger = PdfWriter()
-    
-    # Ajout du récapitulatif en premier
-    merger.append(temp_recap)
-    
-    # Ajout des factures
-    for desc, f_path in factures_a_fusionner:
+@st.cache_resource
+def _thumb_lru():
+    return {"lock": threading.Lock(), "items": OrderedDict()}
+
+def get_thumbnail(image_path, target_size=(400, 300)):
+    """Miniature recadrée en bytes : LRU mémoire, puis cache disque (.cache/thumbs), puis calcul"""
+    try: s = os.stat(image_path)
+    except OSError: return None
+    key = hashlib.sha1(f"{os.path.abspath(image_path)}|{s.st_mtime_ns}|{s.st_size}|{target_size[0]}x{target_size[1]}".encode()).hexdigest()
+    lru = _thumb_lru()
+    with lru["lock"]:
+        if key in lru["items"]:
+            lru["items"].move_to_end(key)
+            return lru["items"][key]
+    path = os.path.join(CACHE_DIR, "thumbs", key + ".webp")
+    if os.path.exists(path):
+        with open(path, "rb") as f: data = f.read()
+    else:
+        img = load_and_crop_image(image_path, target_size)
+        if img is None: return None
+        buf = io.BytesIO()
+        try: img.save(buf, "WEBP", quality=80, method=4)
+        except (KeyError, OSError):
+            buf = io.BytesIO(); img.convert("RGB").save(buf, "JPEG", quality=85, optimize=True)
+        data = buf.getvalue()
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f: f.write(data)
+        os.replace(tmp, path)
+    with lru["lock"]:
+        lru["items"][key] = data
+        while len(lru["items"]) > THUMB_LRU_SIZE: lru["items"].popitem(last=False)
+    return data
+
+# --- Export de flotte (ZIP de dossiers PDF) ---
+EXPORT_MAX_AGE = 24 * 3600
+# Sans spec, les workers "spawn" de export_flotte ré-exécuteraient ce script en guise de __main__
+__spec__ = importlib.machinery.ModuleSpec("__main__", None)
+
+def export_jobs(cars, dates=None):
+    """(nom, lignes d'entretien triées comme sur la fiche) par véhicule, restreintes à la période [début, fin]"""
+    fleet = fleet_index()
+    jobs = []
+    for car in cars:
+        df = fleet.rows("maintenance", car)
+        if dates: df = df[(df['Date'].dt.date >= dates[0]) & (df['Date'].dt.date <= dates[1])]
+        jobs.append((car, df.sort_values('Date', ascending=False)))
+    return jobs
+
+def purge_exports(max_age=EXPORT_MAX_AGE):
+    now = datetime.now().timestamp()
+    with os.scandir(EXPORT_DIR) as it:
+        for entry in it:
+            if entry.is_file() and now - entry.stat().st_mtime > max_age:
+                try: os.remove(entry.path)
+                except FileNotFoundError: pass
+
+def read_bytes(path):
+    with open(path, "rb") as f: return f.read()
+
+# --- Recherche de véhicules : index préfixes -> véhicules, reconstruit quand la config change ---
+SEARCH_FIELDS = ['Marque', 'Modele', 'Plaque', 'Moteur']
+SEARCH_PREFIX_MAX = 8 # Au-delà, filtre sur les mots complets des candidats du préfixe
+PAGE_SIZES = list(dict.fromkeys([int(os.environ.get("GARAGE_PAGE_SIZE", "12")), 12, 24, 48, 96])) # Le premier est la taille par défaut
+NAV_MAX = 50 # Résultats proposés dans la navigation latérale
+
+class CarSearch:
+    """Recherche par début de mot (accents et casse ignorés) sur nom, Marque, Modele, Plaque et Moteur"""
+    def __init__(self, config):
+        self.cars = sorted(k for k in config if not k.startswith("_"))
+        self.order = {car: i for i, car in enumerate(self.cars)}
+        self.words, self.prefixes = {}, {}
+        for car in self.cars:
+            infos = config.get(car) or {}
+            words = set()
+            for value in [car] + [infos.get(f, "") for f in SEARCH_FIELDS]:
+                tokens = tokenize(value)
+                words.update(tokens)
+                if len(tokens) > 1: words.add("".join(tokens)) # "AB-123-CD" trouvable par "ab123"
+            self.words[car] = words
+            for w in words:
+                for n in range(1, min(len(w), SEARCH_PREFIX_MAX) + 1): self.prefixes.setdefault(w[:n], set()).add(car)
+
+    def search(self, query):
+        """Véhicules (ordre alphabétique) dont un mot commence par chacun des termes"""
+        terms = tokenize(query or "")
+        if not terms: return self.cars
+        hits = None
+        for t in terms:
+            found = self.prefixes.get(t[:SEARCH_PREFIX_MAX], set())
+            if len(t) > SEARCH_PREFIX_MAX: found = {car for car in found if any(w.startswith(t) for w in self.words[car])}
+            hits = found if hits is None else hits & found
+            if not hits: return []
+        return sorted(hits, key=self.order.get)
+
+def car_search(config):
+    sig = get_storage().signature("config")
+    index = cache_get("car_search", sig)
+    if index is None:
+        index = CarSearch(config)
+        cache_put("car_search", sig, index)
+    return index
+
+# --- Instrumentation (opt-in) : durée + octets lus/écrits par appel, une trace par rerun ---
+PERF_WRAPPED = ["load_config", "save_config", "load_data", "save_data", "insert_rows", "update_rows", "delete_rows", "apply_patch",
+                "list_vehicles", "car_search", "search_descriptions", "fleet_index", "fleet_alerts", "conso_stats", "refresh_conso", "bulk_import", "save_uploaded_file",
+                "get_car_image_path", "load_and_crop_image", "get_thumbnail", "generer_pdf_complet", "export_flotte"]
+
+def _io_bytes():
+    """Octets lus / écrits par le thread courant (Linux) : les sessions voisines du même serveur
+    ne faussent pas la mesure. Repli sur le processus entier si le noyau ne l'expose pas, (0, 0) ailleurs"""
+    for src in ("/proc/thread-self/io", "/proc/self/io"):
         try:
-            ext = f_path.split('.')[-1].lower()
-            
-            # Si c'est un PDF, on l'ajoute directement
-            if ext == 'pdf':
-                merger.append(f_path)
-            
-            # Si c'est une image, on la convertit en page PDF d'abord
-            elif ext in ['jpg', 'jpeg', 'png', 'webp']:
-                pdf_img = FPDF()
-                pdf_img.add_page()
-                pdf_img.set_font("Arial", 'B', 12)
-                pdf_img.cell(0, 10, f"PJ : {desc}", ln=True)
-                # On essaie d'ajuster l'image à la page (A4 = 210mm large)
-                pdf_img.image(f_path, x=10, y=30, w=190)
-                
-                temp_img_pdf = "temp_img.pdf"
-                pdf_img.output(temp_img_pdf)
-                merger.append(temp_img_pdf)
-                # Pas de suppression immédiate pour éviter les conflits d'accès
-        except Exception as e:
-            print(f"Erreur fusion {f_path}: {e}")
-
-    # 3. Sauvegarde finale
-    final_filename = f"Dossier_Complet_{car_name.replace(' ', '_')}.pdf"
-    merger.write(final_filename)
-    merger.close()
-    
-    # Nettoyage temporaire
-    if os.path.exists(temp_recap): os.remove(temp_recap)
-    if os.path.exists("temp_img.pdf"): os.remove("temp_img.pdf")
-    
-    return final_filename
+            with open(src, "rb") as f: fields = dict(line.split(b": ") for line in f.read().splitlines())
+            return int(fields[b"rchar"]), int(fields[b"wchar"])
+        except (OSError, KeyError, ValueError): continue
+    return 0, 0
+
+class PerfTrace:
+    """Événements chronométrés (imbriqués) d'un rerun, cProfile optionnel"""
+    def __init__(self, page, profile=False):
+        self.page, self.date = page, datetime.now().isoformat(timespec="seconds")
+        self.events, self.depth = [], 0
+        self.profiler = cProfile.Profile() if profile else None
+        self.t0 = time.perf_counter()
+        if self.profiler: self.profiler.enable()
+
+    @contextmanager
+    def section(self, name):
+        r0, w0 = _io_bytes(); t = time.perf_counter(); self.depth += 1
+        try: yield
+        finally:
+            end = time.perf_counter(); r1, w1 = _io_bytes(); self.depth -= 1
+            self.events.append({"nom": name, "niveau": self.depth, "debut_ms": round((t - self.t0) * 1000, 2), "ms": round((end - t) * 1000, 2), "lu": r1 - r0, "ecrit": w1 - w0})
+
+    def finish(self, complete=True):
+        # Rerun coupé (st.rerun, interaction) : la trace s'arrête au dernier événement terminé
+        end = time.perf_counter() if complete else self.t0 + max((e["debut_ms"] + e["ms"] for e in self.events), default=0) / 1000
+        report = None
+        if self.profiler:
+            self.profiler.disable()
+            out = io.StringIO()
+            pstats.Stats(self.profiler, stream=out).sort_stats("cumulative").print_stats(PERF_PROFILE_TOP)
+            report = out.getvalue()
+        return {"date": self.date, "page": self.page, "complet": complete, "total_ms": round((end - self.t0) * 1000, 2),
+                "evenements": sorted(self.events, key=lambda e: e["debut_ms"]), "cprofile": report}
+
+def _record_trace(trace):
+    st.session_state.setdefault("perf_traces", deque(maxlen=PERF_LAST_N)).append(trace)
+    if PERF_LOG:
+        with open(PERF_LOG, "a", encoding="utf-8") as f: f.write(json.dumps(trace, ensure_ascii=False) + "\n")
+
+def _timed(fn, name):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with _trace.section(name): return fn(*args, **kwargs)
+    return wrapper
+
+def perf_section(name):
+    """Bloc chronométré (rendu d'un widget...) ; nullcontext si l'instrumentation est coupée"""
+    return _trace.section(name) if _trace else nullcontext()
+
+_trace = None
+_pending = st.session_state.pop("perf_pending", None)
+if _pending is not None and PERF_ENABLED: _record_trace(_pending.finish(complete=False))
+elif _pending is not None: _pending.finish(complete=False) # Coupe un éventuel cProfile resté actif
+if PERF_ENABLED:
+    _trace = st.session_state["perf_pending"] = PerfTrace(st.session_state.get("selected_car", "Vue d'ensemble"), profile=st.session_state.pop("perf_cprofile", False))
+    # Désactivé, rien n'est enveloppé : aucun surcoût sur les appels
+    for _name in PERF_WRAPPED: globals()[_name] = _timed(globals()[_name], _name)
 
 # --- 4. CHARGEMENT ---
 garage_config = load_config()
-df_maint = load_data("maintenance")
-df_fuel = load_data("carburant")
 
-cars_in_csv = df_maint['Vehicule'].dropna().unique()
+cars_in_csv = list_vehicles("maintenance")
 for c in cars_in_csv:
     if c not in garage_config:
         garage_config[c] = {"Marque": "Inconnu", "Modele": "-", "Plaque": "-", "Moteur": "-", "Huile": "-", "Conso_Th": "-"}
-save_config(garage_config)
-all_cars = sorted(list(garage_config.keys()))
+save_config(garage_config) # no-op si rien n'a changé
+all_cars = sorted(k for k in garage_config if not k.startswith("_"))
 
 # --- 5. CSS ---
 st.markdown("""
@@ -212,13 +1289,22 @@ st.markdown("""
 # --- 6. NAVIGATION ---
 if 'selected_car' not in st.session_state: st.session_state.selected_car = "Vue d'ensemble"
 st.sidebar.title("🏁 Garage V16")
-nav = st.sidebar.selectbox("Navigation", ["Vue d'ensemble"] + all_cars, index=0 if st.session_state.selected_car not in all_cars else all_cars.index(st.session_state.selected_car)+1)
+if os.environ.get("GARAGE_PROFILE") != "1": st.sidebar.toggle("⏱️ Mode performance", key="perf_mode", help="Chronomètre chargements, sauvegardes, images et PDF à chaque rerun")
+search = car_search(garage_config)
+# Les widgets de la vue d'ensemble gardent leur valeur pendant la visite d'une fiche
+for k in ("ov_q", "ov_size", "ov_page", "txt_q", "txt_cars"):
+    if k in st.session_state: st.session_state[k] = st.session_state[k]
+nav_q = st.sidebar.text_input("🔍 Véhicule", key="nav_q", placeholder="Nom, marque, plaque...")
+nav_cars = search.search(nav_q)[:NAV_MAX]
+if st.session_state.selected_car in all_cars and st.session_state.selected_car not in nav_cars: nav_cars = [st.session_state.selected_car] + nav_cars
+nav_opts = ["Vue d'ensemble"] + nav_cars
+nav = st.sidebar.selectbox("Navigation", nav_opts, index=nav_opts.index(st.session_state.selected_car) if st.session_state.selected_car in nav_cars else 0)
 if nav != st.session_state.selected_car: st.session_state.selected_car = nav; st.rerun()
 st.sidebar.markdown("---")
 
 # --- 7. SIDEBAR ---
 with st.sidebar.expander("⚙️ Gérer le Parc Auto"):
-    tab_add, tab_del = st.tabs(["Ajouter", "Supprimer"])
+    tab_add, tab_del, tab_tools = st.tabs(["Ajouter", "Supprimer", "Outils"])
     with tab_add:
         with st.form("new_c"):
             st.write(" **Nouveau Véhicule**")
@@ -244,9 +1330,26 @@ with st.sidebar.expander("⚙️ Gérer le Parc Auto"):
         if st.button("🗑️ Confirmer"):
             if to_del in garage_config:
                 del garage_config[to_del]; save_config(garage_config)
-                df_maint = df_maint[df_maint['Vehicule'] != to_del]; save_data(df_maint, "maintenance")
-                df_fuel = df_fuel[df_fuel['Vehicule'] != to_del]; save_data(df_fuel, "carburant")
+                orphans = fleet_index().rows("maintenance", to_del)['Facture'].tolist()
+                delete_rows("maintenance", car=to_del); delete_rows("carburant", car=to_del)
+                # Âge minimal par défaut : une autre session vient peut-être de renvoyer la même facture (dédoublonnée)
+                gc_invoices(orphans)
                 st.session_state.selected_car = "Vue d'ensemble"; st.success("Supprimé !"); st.rerun()
+    with tab_tools:
+        if st.button("🔄 Recalculer toutes les consos"):
+            st.success(f"{recompute_all_conso()} plein(s) corrigé(s)")
+        if st.button("🧹 Dédoublonner / nettoyer les factures"):
+            n = migrate_invoices()
+            st.success(f"{n} ligne(s) migrée(s), {len(gc_invoices())} fichier(s) orphelin(s) supprimé(s)")
+        st.write("**Import en masse (CSV)**")
+        imp_type = st.radio("Table", ["Entretien", "Plein"], horizontal=True, key="imp_type")
+        imp_file = st.file_uploader("Historique atelier / export carte carburant", type=['csv', 'txt'], key="imp_file")
+        if imp_file and st.button("📥 Importer"):
+            res = bulk_import(imp_file, "maintenance" if imp_type == "Entretien" else "carburant", garage_config)
+            st.success(f"{res['importees']} ligne(s) importée(s) sur {res['lues']} · {res['doublons']} doublon(s) · {res['rejets']} rejet(s)")
+            if res['nouveaux']: st.info("Nouveaux véhicules : " + ", ".join(res['nouveaux']))
+            if res['rapport']:
+                with open(res['rapport'], "rb") as f: st.download_button("Rapport des rejets", f.read(), file_name=os.path.basename(res['rapport']))
 
 if all_cars:
     with st.sidebar.expander("🛠️ Saisie Rapide (+Facture)"):
@@ -263,34 +1366,87 @@ if all_cars:
             if st.form_submit_button("Enregistrer"):
                 if q_type == "Entretien":
                     f_path = save_uploaded_file(q_file)
-                    new = pd.DataFrame([{'Date': pd.to_datetime(q_date), 'Vehicule': q_car, 'Kilometrage': q_km, 'Description': q_desc, 'Cout': q_prix, 'Facture': f_path}])
-                    df_maint = pd.concat([df_maint, new], ignore_index=True); save_data(df_maint, "maintenance")
+                    insert_rows("maintenance", [{'Date': pd.to_datetime(q_date), 'Vehicule': q_car, 'Kilometrage': q_km, 'Description': q_desc, 'Cout': q_prix, 'Facture': f_path}])
                 else:
-                    conso = 0
-                    prev = df_fuel[df_fuel['Vehicule'] == q_car].sort_values('Kilometrage')
-                    if not prev.empty:
-                        dist = q_km - prev.iloc[-1]['Kilometrage']
-                        if dist > 0: conso = (q_litres / dist) * 100
-                    new = pd.DataFrame([{'Date': pd.to_datetime(q_date), 'Vehicule': q_car, 'Kilometrage': q_km, 'Litres': q_litres, 'Prix_Total': q_prix, 'Conso_Calc': round(conso, 2)}])
-                    df_fuel = pd.concat([df_fuel, new], ignore_index=True); save_data(df_fuel, "carburant")
+                    insert_rows("carburant", [{'Date': pd.to_datetime(q_date), 'Vehicule': q_car, 'Kilometrage': q_km, 'Litres': q_litres, 'Prix_Total': q_prix, 'Conso_Calc': 0.0}])
+                    refresh_conso(q_car, since=q_date)
                 st.success("Enregistré !"); st.rerun()
 
 # --- 8. PAGE PRINCIPALE ---
 if st.session_state.selected_car == "Vue d'ensemble":
     st.title("🏎️ Garage - Vue d'Ensemble")
     if not all_cars: st.info("Aucun véhicule.")
+    fleet = fleet_index()
+    alerts = fleet_alerts(garage_config)
+    todo = alerts[alerts['Statut'].isin(["urgent", "a prevoir"])].sort_values(['Statut', 'Ecart'], ascending=[False, False])
+    if not todo.empty:
+        with st.expander(f"🚨 Alertes de la flotte ({(todo['Statut'] == 'urgent').sum()} urgentes, {(todo['Statut'] == 'a prevoir').sum()} à prévoir)"):
+            st.dataframe(todo[['Vehicule', 'Regle', 'Statut', 'Dernier_Km', 'Km_Actuel', 'Ecart', 'Intervalle']], use_container_width=True, hide_index=True)
+    with st.expander("🔎 Rechercher dans les interventions"):
+        t1, t2 = st.columns([3, 2])
+        txt_q = t1.text_input("Mots-clés (début de mot, fautes de frappe tolérées)", key="txt_q", placeholder="ex : filtre gasoil")
+        txt_cars = t2.multiselect("Véhicules", all_cars, key="txt_cars")
+        t3, t4, t5 = st.columns(3)
+        txt_dates = t3.date_input("Période", [], key="txt_dates")
+        txt_min = t4.number_input("Coût min (€)", min_value=0.0, value=None, key="txt_min")
+        txt_max = t5.number_input("Coût max (€)", min_value=0.0, value=None, key="txt_max")
+        if txt_q:
+            res, total = search_descriptions(txt_q, set(txt_cars) or None, txt_dates if len(txt_dates) == 2 else None,
+                                             (txt_min, txt_max) if txt_min is not None or txt_max is not None else None)
+            st.caption(f"{total} intervention(s)" + (f", les {TEXT_LIMIT} plus récentes affichées" if total > TEXT_LIMIT else "") + " · cliquer une ligne pour ouvrir le véhicule")
+            sel = st.dataframe(res[['Vehicule', 'Date', 'Kilometrage', 'Description', 'Cout']], hide_index=True, use_container_width=True, on_select="rerun", selection_mode="single-row", key="txt_res",
+                               column_config={"Date": st.column_config.DateColumn(format="DD/MM/YYYY"), "Cout": st.column_config.NumberColumn(format="%.2f €")})
+            if sel.selection.rows: st.session_state.selected_car = res.iloc[sel.selection.rows[0]]['Vehicule']; st.rerun()
+    with st.expander("📦 Export des dossiers de la flotte (ZIP)"):
+        with st.form("export_zip"):
+            e1, e2 = st.columns(2)
+            exp_scope = e1.radio("Véhicules", ["Toute la flotte", "Résultats de la recherche", "Sélection"], horizontal=True)
+            exp_sel = e1.multiselect("Sélection", all_cars)
+            exp_dates = e2.date_input("Période (optionnel)", [])
+            exp_go = st.form_submit_button("Générer le ZIP")
+        if exp_go:
+            exp_cars = {"Toute la flotte": all_cars, "Résultats de la recherche": search.search(st.session_state.get("ov_q")), "Sélection": exp_sel}[exp_scope]
+            if exp_cars:
+                purge_exports()
+                zip_path = os.path.join(EXPORT_DIR, f"Dossiers_{datetime.now():%Y%m%d_%H%M%S}.zip")
+                bar = st.progress(0.0, text=f"0/{len(exp_cars)} dossier(s)")
+                errors = export_flotte(export_jobs(exp_cars, exp_dates if len(exp_dates) == 2 else None), zip_path,
+                                       progress=lambda done, total, c: bar.progress(done / total, text=f"{done}/{total} dossier(s) · {c}"))
+                st.session_state.export_zip_path = zip_path
+                if errors: st.warning("Échec : " + ", ".join(f"{c} ({e})" for c, e in errors.items()))
+            else: st.error("Aucun véhicule sélectionné")
+        zip_path = st.session_state.get("export_zip_path")
+        if zip_path and os.path.exists(zip_path):
+            # Lu seulement au clic, pas gardé en mémoire entre les reruns
+            st.download_button(f"📥 Télécharger {os.path.basename(zip_path)}", functools.partial(read_bytes, zip_path), file_name=os.path.basename(zip_path), mime="application/zip")
+    reset_page = lambda: st.session_state.update(ov_page=1)
+    f1, f2, f3 = st.columns([4, 1, 1])
+    ov_q = f1.text_input("🔍 Rechercher", key="ov_q", placeholder="Nom, marque, modèle, plaque, moteur", on_change=reset_page)
+    page_size = f2.selectbox("Par page", PAGE_SIZES, key="ov_size", on_change=reset_page)
+    matches = search.search(ov_q)
+    n_pages = max(1, -(-len(matches) // page_size))
+    if st.session_state.get("ov_page", 1) > n_pages: st.session_state.ov_page = n_pages
+    page = f3.number_input("Page", min_value=1, max_value=n_pages, step=1, key="ov_page")
+    visible = matches[(page - 1) * page_size:page * page_size]
+    if all_cars: st.caption(f"{len(matches)} véhicule(s) · page {page}/{n_pages}")
+    # Seules les cartes (et donc les photos) de la page affichée sont construites
     cols = st.columns(3)
-    for i, car in enumerate(all_cars):
-        with cols[i % 3]:
-            with st.container(border=True):
-                img_path = get_car_image_path(car)
-                if img_path:
-                    pil_img = load_and_crop_image(img_path, target_size=(400, 300))
-                    if pil_img: st.image(pil_img, use_container_width=True)
-                else: st.markdown("<div style='height:150px; background:#eee; display:flex; align-items:center; justify-content:center; color:#888;'>Pas de photo</div>", unsafe_allow_html=True)
-                if st.button(f"📂 {car.replace('Voiture - ', '')}", key=f"btn_{car}", use_container_width=True): st.session_state.selected_car = car; st.rerun()
-                infos = garage_config.get(car, {})
-                st.markdown(f"<div style='margin-top:5px; line-height:1.4;'><b>{infos.get('Marque', '-')} {infos.get('Modele', '')}</b><br>🆔 {infos.get('Plaque', '-')}<br>⛽ {infos.get('Moteur', '-')}</div>", unsafe_allow_html=True)
+    with perf_section("vue d'ensemble · cartes"):
+        for i, car in enumerate(visible):
+            with cols[i % 3]:
+                with st.container(border=True):
+                    img_path = get_car_image_path(car)
+                    if img_path:
+                        thumb = get_thumbnail(img_path, target_size=(400, 300))
+                        if thumb: st.image(thumb, use_container_width=True)
+                    else: st.markdown("<div style='height:150px; background:#eee; display:flex; align-items:center; justify-content:center; color:#888;'>Pas de photo</div>", unsafe_allow_html=True)
+                    if st.button(f"📂 {car.replace('Voiture - ', '')}", key=f"btn_{car}", use_container_width=True): st.session_state.selected_car = car; st.rerun()
+                    infos = garage_config.get(car, {})
+                    kpi = fleet.kpi(car)
+                    km = f"{kpi['Km']:,.0f} km" if pd.notna(kpi['Km']) else "- km"
+                    conso = f"{kpi['Conso']:.1f} L/100" if pd.notna(kpi['Conso']) else "- L/100"
+                    vidange = f"{kpi['Vidange_Km']:,.0f} km" if pd.notna(kpi['Vidange_Km']) else "-"
+                    st.markdown(f"<div style='margin-top:5px; line-height:1.4;'><b>{infos.get('Marque', '-')} {infos.get('Modele', '')}</b><br>🆔 {infos.get('Plaque', '-')}<br>⛽ {infos.get('Moteur', '-')}<br><small>📏 {km} · 💶 {kpi['Total']:,.0f} € · 🛢️ {conso} · 📄 {kpi['Factures']:.0f}<br>🔧 Dernière vidange : {vidange}</small></div>", unsafe_allow_html=True)
 else:
     car = st.session_state.selected_car
     st.button("⬅️ Retour", on_click=lambda: st.session_state.update(selected_car="Vue d'ensemble"))
@@ -299,8 +1455,8 @@ else:
     with c1:
         img_path = get_car_image_path(car)
         if img_path:
-            pil_img = load_and_crop_image(img_path, target_size=(500, 350))
-            if pil_img: st.image(pil_img)
+            thumb = get_thumbnail(img_path, target_size=(500, 350))
+            if thumb: st.image(thumb)
         else: st.info("Image manquante")
     with c2:
         st.title(car)
@@ -311,12 +1467,14 @@ else:
         - **Moteur** : **{infos.get('Moteur', '-')}**
         - **Huile** : 🛢️ {infos.get('Huile', 'Non renseigné')}
         """)
-        df_c = df_maint[df_maint['Vehicule'] == car]
-        df_f = df_fuel[df_fuel['Vehicule'] == car]
+        fleet = fleet_index()
+        df_c = fleet.rows("maintenance", car)
+        df_f = fleet.rows("carburant", car)
+        kpi = fleet.kpi(car)
         k1, k2, k3 = st.columns(3)
-        k1.metric("Km Compteur", f"{df_c['Kilometrage'].max() if not df_c.empty else 0:,.0f} km")
-        k2.metric("Total Entretien", f"{df_c['Cout'].sum():,.0f} €")
-        k3.metric("Conso Réelle", f"{df_f[df_f['Conso_Calc']>0]['Conso_Calc'].mean() if not df_f.empty else 0:.1f} L/100")
+        k1.metric("Km Compteur", f"{kpi['Km'] if pd.notna(kpi['Km']) else 0:,.0f} km")
+        k2.metric("Total Entretien", f"{kpi['Total']:,.0f} €")
+        k3.metric("Conso Réelle", f"{kpi['Conso'] if pd.notna(kpi['Conso']) else 0:.1f} L/100")
 
     tab_m, tab_f, tab_a = st.tabs(["🔧 Entretien", "⛽ Carburant", "🚨 Alertes"])
     with tab_m:
@@ -330,8 +1488,8 @@ else:
                 a_file = st.file_uploader("Joindre une facture (PDF/Image)", type=['pdf', 'jpg', 'png'])
                 if st.form_submit_button("✅ VALIDER L'AJOUT", type="primary"):
                     f_path = save_uploaded_file(a_file)
-                    new_row = pd.DataFrame([{'Date': pd.to_datetime(a_date), 'Vehicule': car, 'Kilometrage': a_km, 'Description': a_desc, 'Cout': a_prix, 'Facture': f_path}])
-                    df_maint = pd.concat([df_maint, new_row], ignore_index=True); save_data(df_maint, "maintenance"); st.success("Ligne ajoutée !"); st.rerun()
+                    insert_rows("maintenance", [{'Date': pd.to_datetime(a_date), 'Vehicule': car, 'Kilometrage': a_km, 'Description': a_desc, 'Cout': a_prix, 'Facture': f_path}])
+                    st.success("Ligne ajoutée !"); st.rerun()
         st.write("---")
         with st.expander("🔍 Filtres & Tri"):
             col_t1, col_t2 = st.columns(2)
@@ -340,7 +1498,7 @@ else:
                 sort_asc = st.radio("Ordre", ["Décroissant ⬇️", "Croissant ⬆️"], index=0, horizontal=True)
             with col_t2: filter_date = st.date_input("Filtrer par date", [])
 
-        df_edit_m = df_maint[df_maint['Vehicule'] == car].copy()
+        df_edit_m = df_c.copy()
         is_filtered = False
         if len(filter_date) == 2: df_edit_m = df_edit_m[(df_edit_m['Date'].dt.date >= filter_date[0]) & (df_edit_m['Date'].dt.date <= filter_date[1])]; is_filtered = True
         asc = True if sort_asc == "Croissant ⬆️" else False
@@ -352,11 +1510,15 @@ else:
             st.dataframe(df_edit_m[['Date', 'Kilometrage', 'Description', 'Cout', 'Facture_Dispo']], use_container_width=True, hide_index=True)
         else:
             st.info("💡 Mode Édition. Clic sur ligne + Suppr pour effacer.")
-            edited_m = st.data_editor(df_edit_m, num_rows="dynamic", use_container_width=True, hide_index=True, key="edit_m", column_config={"Date": st.column_config.DateColumn(format="DD/MM/YYYY"), "Cout": st.column_config.NumberColumn(format="%.2f €"), "Vehicule": st.column_config.Column(disabled=True), "Facture": st.column_config.Column(disabled=True), "Facture_Dispo": st.column_config.Column("Facture ?", disabled=True)})
+            base_m = editor_base("edit_m", car, df_edit_m)
+            if base_m["rows"] is not df_edit_m: st.caption("✏️ Modifications en cours : tableau figé jusqu'à la sauvegarde")
+            with perf_section("st.data_editor · entretien"): st.data_editor(base_m["rows"], num_rows="dynamic", use_container_width=True, hide_index=True, key="edit_m", column_config={"Date": st.column_config.DateColumn(format="DD/MM/YYYY"), "Cout": st.column_config.NumberColumn(format="%.2f €"), "Vehicule": st.column_config.Column(disabled=True), "Facture": st.column_config.Column(disabled=True), "Facture_Dispo": st.column_config.Column("Facture ?", disabled=True)})
             if st.button("💾 Sauvegarder Tableau", type="primary"):
-                df_others = df_maint[df_maint['Vehicule'] != car]
-                edited_m['Vehicule'] = car
-                df_maint = pd.concat([df_others, edited_m.drop(columns=['Facture_Dispo'])], ignore_index=True); save_data(df_maint, "maintenance"); st.success("Mis à jour !"); st.rerun()
+                conflicts = apply_patch("maintenance", car, base_m, *editor_patch(st.session_state["edit_m"], base_m["rows"], "maintenance", car))
+                if conflicts:
+                    st.error(f"{len(conflicts)} ligne(s) modifiée(s) entre-temps par une autre session : rien n'a été enregistré.")
+                    st.button("🔄 Recharger (abandonner mes modifications)", key="reload_m", on_click=lambda: st.session_state.pop("edit_m_base", None))
+                else: st.session_state.pop("edit_m_base", None); st.success("Mis à jour !"); st.rerun()
 
         st.write("---")
         c1, c2 = st.columns(2)
@@ -364,7 +1526,7 @@ else:
             st.subheader("🖨️ Export Complet")
             if st.button("Générer Dossier PDF (Tableau + Factures)"):
                 pdf = generer_pdf_complet(car, df_edit_m)
-                with open(pdf, "rb") as f: st.download_button("📥 Télécharger le PDF Complet", f, file_name=pdf)
+                st.download_button("📥 Télécharger le PDF Complet", pdf, file_name=dossier_filename(car), mime="application/pdf")
         with c2:
             st.subheader("📥 Télécharger une facture seule")
             facts = df_edit_m[['Date', 'Description', 'Facture']].dropna()
@@ -374,29 +1536,74 @@ else:
                 if format_fact is not None:
                     f_path = facts.loc[format_fact, 'Facture']
                     if os.path.exists(f_path):
-                        with open(f_path, "rb") as f: st.download_button("Télécharger Fichier", f, file_name=os.path.basename(f_path))
+                        with open(f_path, "rb") as f: st.download_button("Télécharger Fichier", f, file_name=invoice_name(f_path))
             else: st.caption("Aucune facture.")
 
     with tab_f:
-        df_edit_f = df_fuel[df_fuel['Vehicule'] == car].sort_values('Date', ascending=False)
-        edited_f = st.data_editor(df_edit_f, num_rows="dynamic", use_container_width=True, hide_index=True, key="edit_f", column_config={"Date": st.column_config.DateColumn(format="DD/MM/YYYY"), "Vehicule": st.column_config.Column(disabled=True)})
+        stats = conso_stats(df_f, garage_config)
+        if car in stats.index:
+            cs = stats.loc[car]
+            s1, s2, s3 = st.columns(3)
+            s1.metric("Médiane", f"{cs['Mediane']:.1f} L/100")
+            s2.metric(f"Moyenne {CONSO_WINDOW} derniers pleins", f"{cs['Glissante']:.1f} L/100", delta=f"{cs['Ecart_%']:+.0f} % vs théorique" if pd.notna(cs['Ecart_%']) else None, delta_color="inverse")
+            s3.metric("Théorique", f"{cs['Theorique']:.1f} L/100" if pd.notna(cs['Theorique']) else "-")
+        df_edit_f = df_f.sort_values('Date', ascending=False)
+        base_f = editor_base("edit_f", car, df_edit_f)
+        if base_f["rows"] is not df_edit_f: st.caption("✏️ Modifications en cours : tableau figé jusqu'à la sauvegarde")
+        with perf_section("st.data_editor · carburant"): st.data_editor(base_f["rows"], num_rows="dynamic", use_container_width=True, hide_index=True, key="edit_f", column_config={"Date": st.column_config.DateColumn(format="DD/MM/YYYY"), "Vehicule": st.column_config.Column(disabled=True)})
         if st.button("💾 Sauvegarder Pleins", type="primary"):
-            df_others = df_fuel[df_fuel['Vehicule'] != car]
-            edited_f['Vehicule'] = car
-            df_fuel = pd.concat([df_others, edited_f], ignore_index=True); save_data(df_fuel, "carburant"); st.success("OK"); st.rerun()
+            patch_f = editor_patch(st.session_state["edit_f"], base_f["rows"], "carburant", car)
+            conflicts = apply_patch("carburant", car, base_f, *patch_f)
+            if conflicts:
+                st.error(f"{len(conflicts)} plein(s) modifié(s) entre-temps par une autre session : rien n'a été enregistré.")
+                st.button("🔄 Recharger (abandonner mes modifications)", key="reload_f", on_click=lambda: st.session_state.pop("edit_f_base", None))
+            else:
+                st.session_state.pop("edit_f_base", None)
+                if any(patch_f): refresh_conso(car, since=patch_since(base_f["rows"], *patch_f))
+                st.success("OK"); st.rerun()
 
     with tab_a:
         st.subheader("⚠️ Alertes")
         messages = []
-        vid = df_edit_m[df_edit_m['Description'].str.contains('vidange', case=False, na=False)]
-        km_now = df_c['Kilometrage'].max() if not df_c.empty else 0
-        if not vid.empty:
-            diff = km_now - vid.iloc[0]['Kilometrage']
-            if diff > 15000: m=f"URGENT: Vidange (+{diff-15000}km)"; st.error(m); messages.append(m)
-            elif diff > 12000: m=f"PREVOIR: Vidange bientôt (+{diff}km)"; st.warning(m); messages.append(m)
-            else: st.success(f"Vidange OK ({diff}km)")
-        else: st.info("Pas d'historique vidange"); messages.append("Pas d'historique vidange.")
+        alerts = fleet_alerts(garage_config)
+        car_alerts = alerts[alerts['Vehicule'] == car]
+        km_now = int(car_alerts['Km_Actuel'].max()) if not car_alerts.empty else 0
+        for a in car_alerts.itertuples():
+            if a.Statut == "urgent": m=f"URGENT: {a.Regle} (+{a.Ecart - a.Intervalle:.0f}km)"; st.error(m); messages.append(m)
+            elif a.Statut == "a prevoir": m=f"PREVOIR: {a.Regle} bientôt (+{a.Ecart:.0f}km)"; st.warning(m); messages.append(m)
+            elif a.Statut == "ok": st.success(f"{a.Regle} OK ({a.Ecart:.0f}km)")
+        missing = car_alerts.loc[car_alerts['Statut'] == "aucun historique", 'Regle'].tolist()
+        if missing: st.info("Pas d'historique : " + ", ".join(missing))
+        if "Vidange" in missing: messages.append("Pas d'historique vidange.")
         st.write("---")
         sujet = f"Rapport - {car}"; corps = f"Etat {car} ({km_now}km):\n\n" + ("ALERTES:\n"+"\n".join(messages) if messages else "OK")
         lnk = f"mailto:?subject={urllib.parse.quote(sujet)}&body={urllib.parse.quote(corps)}"
-        st.markdown(f"""<a href="{lnk}" class="email-btn" target="_blank">📧 Envoyer Rapport</a>""", unsafe_allow_html=True)
\ No newline at end of file
+        st.markdown(f"""<a href="{lnk}" class="email-btn" target="_blank">📧 Envoyer Rapport</a>""", unsafe_allow_html=True)
+
+# --- 9. PERFORMANCE ---
+if _trace:
+    _record_trace(st.session_state.pop("perf_pending").finish())
+    traces = list(st.session_state["perf_traces"])
+    with st.sidebar.expander("⏱️ Performance"):
+        last = traces[-1]
+        st.caption(f"Dernier rerun ({last['page']}) : {last['total_ms']:.0f} ms" + (f" · trace ajoutée à {PERF_LOG}" if PERF_LOG else ""))
+        ev = pd.DataFrame(last['evenements'], columns=['nom', 'niveau', 'debut_ms', 'ms', 'lu', 'ecrit'])
+        if not ev.empty:
+            # Durées inclusives : fleet_index contient les load_data qu'il déclenche
+            agg = ev.groupby('nom').agg(appels=('ms', 'size'), ms=('ms', 'sum'), lu_ko=('lu', 'sum'), ecrit_ko=('ecrit', 'sum')).sort_values('ms', ascending=False)
+            agg[['lu_ko', 'ecrit_ko']] = agg[['lu_ko', 'ecrit_ko']] / 1024
+            st.dataframe(agg.round(1), use_container_width=True)
+        # Historique : appels de premier niveau empilés, le reste = rendu Streamlit et code non instrumenté
+        hist = {}
+        for n, t in enumerate(traces, 1):
+            top = {}
+            for e in t['evenements']:
+                if e['niveau'] == 0: top[e['nom']] = top.get(e['nom'], 0) + e['ms']
+            top['(reste)'] = max(t['total_ms'] - sum(top.values()), 0)
+            hist[f"{n:02d} {t['date'][11:]}" + ("" if t['complet'] else " ⏹")] = top
+        st.bar_chart(pd.DataFrame.from_dict(hist, orient='index').fillna(0), y_label="ms")
+        st.button("🔬 cProfile du prochain rerun", on_click=lambda: st.session_state.update(perf_cprofile=True))
+        profiled = [t for t in traces if t['cprofile']]
+        if profiled:
+            st.caption(f"cProfile du rerun de {profiled[-1]['date'][11:]} ({profiled[-1]['page']})")
+            st.code(profiled[-1]['cprofile'], language=None)
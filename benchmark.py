@@ -0,0 +1,282 @@
+"""Benchmarks de l'appli sur une flotte synthétique (déterministe).
+
+    python benchmark.py run --vehicles 1000 --maint-rows 200000 --fuel-rows 200000 --out bench.json
+    python benchmark.py compare avant.json apres.json
+
+Chaque mesure donne le temps (médiane des répétitions), le pic de RSS et les octets écrits.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import resource
+import runpy
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+from fpdf import FPDF
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+APP = os.path.join(REPO, "app.py")
+
+DESCRIPTIONS = [
+    "vidange + filtre huile", "filtre gazoil + filtre air", "plaquettes avant", "courroie distribution + pompe a eau",
+    "vidange boite", "pneus x4", "controle technique", "disques + plaquettes arriere", "batterie", "amortisseurs avant",
+]
+MOTEURS = ["1.6 HDi 110", "2.0 dCi 175", "1.2 16V 75ch", "2.8L Essence (6 Cyl)", "1.9d (Atmo)"]
+
+# --- Génération de la flotte ---
+def generate_fleet(workdir, vehicles, maint_rows, fuel_rows, photos, invoices, seed=42):
+    rng = np.random.default_rng(seed)
+    names = [f"Vehicule {i:05d}" for i in range(vehicles)]
+    config = {n: {"Plaque": f"{chr(65 + i % 26)}{chr(65 + i // 26 % 26)}-{i % 1000:03d}-ZZ", "Desc": "Bench", "Marque": "Marque", "Modele": f"M{i % 7}",
+                  "Moteur": MOTEURS[i % len(MOTEURS)], "Huile": "5.0L (5W30)", "Conso_Th": "6.0L/100"} for i, n in enumerate(names)}
+    with open(os.path.join(workdir, "garage_config.json"), "w") as f: json.dump(config, f, indent=4)
+
+    os.makedirs(os.path.join(workdir, "factures"), exist_ok=True)
+    os.makedirs(os.path.join(workdir, "photos"), exist_ok=True)
+    # Factures : images JPEG et PDF d'une page, rattachées aux 10 % premiers véhicules
+    pdf = FPDF(); pdf.add_page(); pdf.set_font("Arial", '', 12); pdf.cell(0, 10, "Facture atelier")
+    pdf_bytes = pdf.output(dest='S').encode('latin-1')
+    invoice_paths = []
+    for i in range(invoices):
+        if i % 3 == 2:
+            path = os.path.join("factures", f"facture_{i:05d}.pdf")
+            with open(os.path.join(workdir, path), "wb") as f: f.write(pdf_bytes + f"\n%{i}\n".encode())
+        else:
+            path = os.path.join("factures", f"facture_{i:05d}.jpg")
+            _image(rng, (2480, 3508) if i % 2 else (1600, 1200)).save(os.path.join(workdir, path), quality=90)
+        invoice_paths.append(path)
+    for i in range(min(photos, vehicles)):
+        _image(rng, (1600, 1200)).save(os.path.join(workdir, "photos", names[i] + ".jpg"), quality=90)
+
+    veh = np.array(names)[rng.integers(0, vehicles, maint_rows)]
+    facture = np.full(maint_rows, None, dtype=object)
+    if invoice_paths:
+        owners = max(1, vehicles // 10)
+        rows = rng.choice(maint_rows, size=min(len(invoice_paths), maint_rows), replace=False)
+        veh[rows] = np.array(names[:owners])[np.arange(len(rows)) % owners]
+        facture[rows] = invoice_paths[:len(rows)]
+    pd.DataFrame({
+        "Date": (pd.Timestamp("2015-01-01") + pd.to_timedelta(rng.integers(0, 3650, maint_rows), unit="D")).strftime("%Y-%m-%d"),
+        "Vehicule": veh,
+        "Kilometrage": rng.integers(0, 300000, maint_rows),
+        "Description": np.array(DESCRIPTIONS)[rng.integers(0, len(DESCRIPTIONS), maint_rows)],
+        "Cout": rng.uniform(20, 1500, maint_rows).round(2),
+        "Facture": facture,
+    }).to_csv(os.path.join(workdir, "base_entretien_propre.csv"), index=False)
+    pd.DataFrame({
+        "Date": (pd.Timestamp("2015-01-01") + pd.to_timedelta(rng.integers(0, 3650, fuel_rows), unit="D")).strftime("%Y-%m-%d"),
+        "Vehicule": np.array(names)[rng.integers(0, vehicles, fuel_rows)],
+        "Kilometrage": rng.integers(0, 300000, fuel_rows),
+        "Litres": rng.uniform(20, 60, fuel_rows).round(2),
+        "Prix_Total": rng.uniform(30, 110, fuel_rows).round(2),
+        "Conso_Calc": 0.0,
+    }).to_csv(os.path.join(workdir, "suivi_carburant.csv"), index=False)
+    return names
+
+def _image(rng, size):
+    # Dégradé + bruit léger : se compresse comme une vraie photo, se génère vite
+    w, h = size
+    base = np.linspace(0, 255, w, dtype=np.uint8)[None, :, None].repeat(h, 0).repeat(3, 2)
+    noise = rng.integers(0, 40, (h // 8, w // 8, 3), dtype=np.uint8).repeat(8, 0).repeat(8, 1)
+    return Image.fromarray(base[:h // 8 * 8, :w // 8 * 8] + noise)
+
+# --- Mesures ---
+def _rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"): return int(line.split()[1]) / 1024
+    except OSError: pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _written():
+    try:
+        with open("/proc/self/io") as f:
+            return next(int(line.split()[1]) for line in f if line.startswith("wchar:"))
+    except (OSError, StopIteration): return None
+
+class Probe:
+    """Temps, pic de RSS (échantillonné toutes les 5 ms) et octets écrits pendant le bloc"""
+    def __enter__(self):
+        self.peak, self._stop = _rss_mb(), threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True); self._thread.start()
+        self.w0, self.t0 = _written(), time.perf_counter()
+        return self
+
+    def _sample(self):
+        while not self._stop.wait(0.005): self.peak = max(self.peak, _rss_mb())
+
+    def __exit__(self, *exc):
+        self.wall = time.perf_counter() - self.t0
+        w1 = _written()
+        self._stop.set(); self._thread.join()
+        self.peak = max(self.peak, _rss_mb())
+        self.bytes_written = w1 - self.w0 if w1 is not None and self.w0 is not None else None
+
+def measure(results, name, fn, repeat=3, setup=None):
+    runs = []
+    for _ in range(repeat):
+        if setup: setup()
+        with Probe() as p: fn()
+        runs.append(p)
+    results[name] = {
+        "wall_s": float(np.median([r.wall for r in runs])),
+        "runs": [round(r.wall, 6) for r in runs],
+        "peak_rss_mb": round(max(r.peak for r in runs), 1),
+        "bytes_written": max((r.bytes_written for r in runs if r.bytes_written is not None), default=None),
+    }
+    _print(name, results[name])
+
+def _print(name, r):
+    print(f"  {name:<34} {r['wall_s'] * 1000:10.1f} ms  {r['peak_rss_mb']:8.1f} Mo RSS  {r['bytes_written'] or 0:>12} o écrits")
+
+# --- Scénarios ---
+def run(args):
+    args.out, cwd = os.path.abspath(args.out), os.getcwd() # Relatif au dossier de lancement, pas au dossier de travail
+    workdir = tempfile.mkdtemp(prefix="garage_bench_")
+    print(f"Flotte synthétique dans {workdir}")
+    names = generate_fleet(workdir, args.vehicles, args.maint_rows, args.fuel_rows, args.photos, args.invoices, args.seed)
+    os.chdir(workdir)
+    sys.path.insert(0, REPO)
+    os.environ["GARAGE_STORAGE"] = args.storage
+    results = {}
+    try:
+        # Premier import : exécute le script une fois en mode "bare" (migration SQLite comprise)
+        ns = {}
+        measure(results, "import_app", lambda: ns.update(runpy.run_path(APP)), repeat=1)
+        st = ns["st"]
+
+        def cold(*dirs):
+            def reset():
+                st.cache_resource.clear()
+                for d in dirs: shutil.rmtree(os.path.join(".cache", d), ignore_errors=True)
+                os.makedirs(os.path.join(".cache", "thumbs"), exist_ok=True)
+            return reset
+
+        measure(results, "load_config_cold", ns["load_config"], args.repeat, setup=cold())
+        measure(results, "load_config_warm", ns["load_config"], args.repeat)
+        for key in ("maintenance", "carburant"):
+            measure(results, f"load_data_{key}_cold", lambda: ns["load_data"](key), args.repeat, setup=cold())
+            measure(results, f"load_data_{key}_warm", lambda: ns["load_data"](key), args.repeat)
+        df_maint = ns["load_data"]("maintenance")
+        measure(results, "save_data_maintenance", lambda: ns["save_data"](df_maint, "maintenance"), args.repeat)
+        row = {"Date": pd.Timestamp("2024-01-01"), "Vehicule": names[0], "Kilometrage": 1, "Description": "bench", "Cout": 1.0, "Facture": None}
+        measure(results, "insert_rows_single", lambda: ns["insert_rows"]("maintenance", [row]), args.repeat)
+        measure(results, "fleet_index_cold", ns["fleet_index"], args.repeat, setup=cold())
+
+        def grid_pil():
+            for car in names:
+                path = ns["get_car_image_path"](car)
+                if path: ns["load_and_crop_image"](path, target_size=(400, 300))
+        def grid_thumbs():
+            for car in names:
+                path = ns["get_car_image_path"](car)
+                if path: ns["get_thumbnail"](path, target_size=(400, 300))
+        measure(results, "overview_images_pil", grid_pil, args.repeat)
+        measure(results, "overview_thumbs_cold", grid_thumbs, args.repeat, setup=cold("thumbs"))
+        measure(results, "overview_thumbs_warm", grid_thumbs, args.repeat)
+
+        fleet = ns["fleet_index"]()
+        car = fleet.summary['Factures'].idxmax() if not fleet.summary.empty else names[0]
+        df_car = fleet.rows("maintenance", car)
+        measure(results, "generer_pdf_complet_cold", lambda: ns["generer_pdf_complet"](car, df_car), args.repeat, setup=cold("pdf"))
+        measure(results, "generer_pdf_complet_warm", lambda: ns["generer_pdf_complet"](car, df_car), args.repeat)
+
+        if not args.skip_apptest:
+            # Processus séparé : le script tourne dans un runtime Streamlit propre, sans l'import "bare" ci-dessus
+            out = subprocess.run([sys.executable, os.path.abspath(__file__), "apptest", workdir, car, "--repeat", str(args.repeat)],
+                                 capture_output=True, text=True, env={**os.environ, "GARAGE_STORAGE": args.storage})
+            if out.returncode: print(out.stderr[-2000:])
+            else:
+                for name, r in json.loads(out.stdout.strip().splitlines()[-1]).items(): results[name] = r; _print(name, r)
+    finally:
+        os.chdir(cwd)
+        if not args.keep: shutil.rmtree(workdir, ignore_errors=True)
+
+    try: commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO, capture_output=True, text=True).stdout.strip() or None
+    except OSError: commit = None
+    out = {"meta": {"commit": commit, "date": datetime.now().isoformat(timespec="seconds"), "python": platform.python_version(),
+                    "platform": platform.platform(), "cpus": os.cpu_count(),
+                    "params": {k: v for k, v in vars(args).items() if k not in ("func", "out")}},
+           "results": results}
+    with open(args.out, "w") as f: json.dump(out, f, indent=2)
+    print(f"Résultats : {args.out}")
+
+def apptest(args):
+    """Script Streamlit de bout en bout via AppTest (appelé par `run` dans un sous-processus)"""
+    import logging
+    logging.disable(logging.WARNING)
+    from streamlit.testing.v1 import AppTest
+    os.chdir(args.workdir)
+    sys.path.insert(0, REPO)
+    results = {}
+    at = AppTest.from_file(APP, default_timeout=600)
+    with contextlib.redirect_stdout(sys.stderr):
+        measure(results, "apptest_overview_first", at.run, 1)
+        measure(results, "apptest_overview_rerun", at.run, args.repeat)
+        def detail():
+            at.session_state["selected_car"] = args.car
+            at.run()
+        measure(results, "apptest_detail", detail, args.repeat)
+    if at.exception: print("\n".join(e.value for e in at.exception), file=sys.stderr)
+    print(json.dumps(results))
+
+def compare(args):
+    with open(args.old) as f: old = json.load(f)
+    with open(args.new) as f: new = json.load(f)
+    print(f"{'mesure':<34} {old['meta'].get('commit') or 'avant':>12} {new['meta'].get('commit') or 'après':>12}   ratio")
+    regressions = []
+    for name in sorted(set(old["results"]) | set(new["results"])):
+        a, b = old["results"].get(name), new["results"].get(name)
+        if not a or not b:
+            cells = [f"{r['wall_s'] * 1000:.1f}ms" if r else "-" for r in (a, b)]
+            print(f"{name:<34} {cells[0]:>12} {cells[1]:>12}")
+            continue
+        ratio = b["wall_s"] / a["wall_s"] if a["wall_s"] else float("inf")
+        flag = ""
+        if ratio > 1 + args.threshold: flag = "  <-- RÉGRESSION"; regressions.append(name)
+        elif ratio < 1 - args.threshold: flag = "  (mieux)"
+        print(f"{name:<34} {a['wall_s'] * 1000:10.1f}ms {b['wall_s'] * 1000:10.1f}ms {ratio:7.2f}x{flag}")
+    if old["meta"].get("params") != new["meta"].get("params"): print("Attention : paramètres de flotte différents entre les deux fichiers.")
+    return 1 if regressions else 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("run", help="Génère une flotte et mesure l'appli")
+    p.add_argument("--vehicles", type=int, default=100)
+    p.add_argument("--maint-rows", type=int, default=50_000)
+    p.add_argument("--fuel-rows", type=int, default=50_000)
+    p.add_argument("--photos", type=int, default=100)
+    p.add_argument("--invoices", type=int, default=200)
+    p.add_argument("--storage", choices=["sqlite", "csv"], default="sqlite")
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--seed", type=int, default=42)
+    p.add_argument("--skip-apptest", action="store_true", help="Ne pas lancer le script Streamlit de bout en bout")
+    p.add_argument("--keep", action="store_true", help="Conserver le dossier de la flotte générée")
+    p.add_argument("--out", default="bench.json")
+    p.set_defaults(func=run)
+    a = sub.add_parser("apptest", help=argparse.SUPPRESS)
+    a.add_argument("workdir"); a.add_argument("car")
+    a.add_argument("--repeat", type=int, default=3)
+    a.set_defaults(func=apptest)
+    c = sub.add_parser("compare", help="Compare deux fichiers de résultats")
+    c.add_argument("old"); c.add_argument("new")
+    c.add_argument("--threshold", type=float, default=0.10, help="Écart relatif signalé (défaut 10 %%)")
+    c.set_defaults(func=compare)
+    args = parser.parse_args(argv)
+    return args.func(args) or 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,235 @@
+"""Dossier PDF d'un véhicule (récapitulatif + factures), assemblé entièrement en mémoire.
+
+Module séparé de app.py pour que les fonctions de rendu soient importables par les workers.
+"""
+import hashlib
+import io
+import multiprocessing
+import os
+import re
+import threading
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+import pandas as pd
+from PIL import Image, ImageOps
+from fpdf import FPDF
+from pypdf import PdfWriter
+
+IMAGE_EXTS = ['jpg', 'jpeg', 'png', 'webp']
+PAGE_DPI = 150 # Suffisant pour relire une facture, ~1100 px sur 190 mm
+JPEG_QUALITY = 80
+MAX_W, MAX_H = int(190 / 25.4 * PAGE_DPI), int(257 / 25.4 * PAGE_DPI)
+
+CACHE_DIR = os.path.join(".cache", "pdf")
+CACHE_MAX_BYTES = int(os.environ.get("GARAGE_PDF_CACHE_MB", "500")) * 2**20
+
+_pool = None
+_pool_workers = None # Imposé à 1 dans les workers d'export_flotte (le parallélisme est déjà entre processus)
+_hash_memo = {}
+_hash_lock = threading.Lock()
+
+def _get_pool():
+    # Le décodage / redimensionnement / encodage PIL relâche le GIL : des threads suffisent
+    global _pool
+    if _pool is None: _pool = ThreadPoolExecutor(max_workers=_pool_workers or os.cpu_count() or 2)
+    return _pool
+
+def _pdf_bytes(pdf):
+    out = pdf.output(dest='S')
+    return out.encode('latin-1') if isinstance(out, str) else bytes(out)
+
+# --- Cache disque (clé = empreinte du contenu), éviction LRU sur la date d'accès ---
+def file_hash(path):
+    """SHA-256 du contenu, mémorisé tant que (mtime, taille) ne bougent pas"""
+    name, _ = os.path.splitext(os.path.basename(path))
+    if len(name) == 64 and all(c in "0123456789abcdef" for c in name): return name # Facture déjà nommée par son SHA-256
+    st = os.stat(path)
+    memo_key = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+    with _hash_lock:
+        if memo_key in _hash_memo: return _hash_memo[memo_key]
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""): h.update(chunk)
+    with _hash_lock: _hash_memo[memo_key] = h.hexdigest()
+    return h.hexdigest()
+
+def _cache_path(key): return os.path.join(CACHE_DIR, key + ".pdf")
+
+def cache_read(key):
+    path = _cache_path(key)
+    try:
+        with open(path, "rb") as f: data = f.read()
+        os.utime(path) # Marque l'entrée comme récemment utilisée
+        return data
+    except FileNotFoundError: return None
+
+def cache_write(key, data):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f: f.write(data)
+    os.replace(tmp, _cache_path(key))
+
+def cache_evict(max_bytes=CACHE_MAX_BYTES):
+    """Supprime les entrées les moins récemment utilisées au-delà de max_bytes"""
+    try: entries = [(e.stat().st_mtime_ns, e.stat().st_size, e.path) for e in os.scandir(CACHE_DIR) if e.name.endswith(".pdf")]
+    except FileNotFoundError: return
+    total = 0
+    for _, size, path in sorted(entries, reverse=True):
+        total += size
+        if total > max_bytes:
+            try: os.remove(path)
+            except FileNotFoundError: pass
+
+def dossier_key(car_name, df_car, hashes):
+    """Empreinte des lignes du véhicule (dans l'ordre affiché) + contenu des factures + date du jour"""
+    h = hashlib.sha256(f"{car_name}|{datetime.now():%Y-%m-%d}|{PAGE_DPI}|{JPEG_QUALITY}".encode())
+    h.update(df_car[['Date', 'Kilometrage', 'Description', 'Cout', 'Facture']].to_csv(index=False).encode())
+    for f_hash in hashes: h.update(f_hash.encode())
+    return "dossier-" + h.hexdigest()
+
+def has_facture(f_path):
+    f_path = str(f_path)
+    return bool(f_path) and f_path != "None" and f_path != "nan" and os.path.exists(f_path)
+
+def dossier_filename(car_name): return f"Dossier_Complet_{car_name.replace(' ', '_')}.pdf"
+
+def render_recap(car_name, df_car):
+    """Page(s) récapitulatives (tableau des interventions) en bytes"""
+    pdf = FPDF()
+    pdf.add_page()
+    pdf.set_font("Arial", 'B', 16)
+    pdf.cell(0, 10, f"Dossier Entretien - {car_name}", ln=True, align='C')
+    pdf.ln(10)
+    pdf.set_font("Arial", '', 12)
+    pdf.cell(0, 10, f"Dossier genere le {datetime.now().strftime('%d/%m/%Y')}", ln=True)
+    pdf.ln(5)
+
+    # Tableau
+    pdf.set_font("Arial", 'B', 10)
+    pdf.cell(25, 10, "Date", 1)
+    pdf.cell(25, 10, "Km", 1)
+    pdf.cell(95, 10, "Description", 1)
+    pdf.cell(25, 10, "Prix", 1)
+    pdf.cell(20, 10, "PJ", 1)
+    pdf.ln()
+
+    pdf.set_font("Arial", '', 9)
+    total = 0
+    for _, row in df_car.iterrows():
+        d = row['Date'].strftime('%d/%m/%Y') if pd.notna(row['Date']) else "-"
+        c = row['Cout'] if pd.notna(row['Cout']) else 0
+        total += c
+        pdf.cell(25, 10, d, 1)
+        pdf.cell(25, 10, str(row['Kilometrage']), 1)
+        pdf.cell(95, 10, str(row['Description'])[:60], 1)
+        pdf.cell(25, 10, f"{c:.0f} E", 1)
+        pdf.cell(20, 10, "OUI" if has_facture(row['Facture']) else "NON", 1)
+        pdf.ln()
+
+    pdf.ln(5)
+    pdf.set_font("Arial", 'B', 12)
+    pdf.cell(0, 10, f"TOTAL INVESTI : {total:,.2f} Euros", ln=True, align='R')
+    return _pdf_bytes(pdf)
+
+def render_image_page(desc, f_path):
+    """Facture image -> page PDF, image réduite à PAGE_DPI et recompressée en JPEG"""
+    img = ImageOps.exif_transpose(Image.open(f_path))
+    img.thumbnail((MAX_W, MAX_H), Image.Resampling.LANCZOS)
+    # FPDF 1.7 n'accepte qu'un chemin de fichier : fichier temporaire unique, supprimé aussitôt
+    fd, tmp = tempfile.mkstemp(suffix=".jpg")
+    try:
+        with os.fdopen(fd, "wb") as f: img.convert("RGB").save(f, "JPEG", quality=JPEG_QUALITY, optimize=True)
+        pdf = FPDF()
+        pdf.add_page()
+        pdf.set_font("Arial", 'B', 12)
+        pdf.cell(0, 10, f"PJ : {desc}", ln=True)
+        # A4 = 210 x 297 mm : on tient dans 190 x 257 mm sans déformer
+        if img.height * 190 > img.width * 257: pdf.image(tmp, x=10, y=30, h=257)
+        else: pdf.image(tmp, x=10, y=30, w=190)
+        return _pdf_bytes(pdf)
+    finally: os.remove(tmp)
+
+def cached_image_page(desc, f_path, f_hash):
+    key = "page-" + hashlib.sha256(f"{f_hash}|{desc}|{PAGE_DPI}|{JPEG_QUALITY}".encode()).hexdigest()
+    page = cache_read(key)
+    if page is None:
+        page = render_image_page(desc, f_path)
+        cache_write(key, page)
+    return page
+
+def generer_pdf_complet(car_name, df_car):
+    """Génère un PDF Récapitulatif + Fusionne les factures à la suite, renvoie les bytes"""
+    factures = [(row['Description'], str(row['Facture'])) for _, row in df_car.iterrows() if has_facture(row['Facture'])]
+    hashes = [file_hash(f_path) for _, f_path in factures]
+    key = dossier_key(car_name, df_car, hashes)
+    cached = cache_read(key)
+    if cached is not None: return cached
+
+    # Les pages images (déjà converties ou non) sont préparées en parallèle pendant le récapitulatif
+    pool = _get_pool()
+    pages = [pool.submit(cached_image_page, desc, f_path, f_hash) if f_path.split('.')[-1].lower() in IMAGE_EXTS else None for (desc, f_path), f_hash in zip(factures, hashes)]
+
+    merger = PdfWriter()
+    merger.append(io.BytesIO(render_recap(car_name, df_car)))
+    complete = True
+    for (desc, f_path), page in zip(factures, pages):
+        try:
+            if page is not None: merger.append(io.BytesIO(page.result()))
+            elif f_path.split('.')[-1].lower() == 'pdf': merger.append(f_path)
+        except Exception as e:
+            print(f"Erreur fusion {f_path}: {e}")
+            complete = False
+
+    out = io.BytesIO()
+    merger.write(out)
+    merger.close()
+    # Dossier incomplet : pas mis en cache, la facture sera retentée au prochain export
+    if complete:
+        cache_write(key, out.getvalue())
+        cache_evict()
+    return out.getvalue()
+
+# --- Export de flotte : un dossier par véhicule dans un pool de processus, ajouté au ZIP dès qu'il est prêt ---
+def _init_export_worker():
+    global _pool_workers
+    _pool_workers = 1
+
+def zip_names(car_names):
+    """Nom d'entrée ZIP par véhicule : caractères sûrs uniquement, suffixe _2, _3... en cas de collision"""
+    names, used = {}, set()
+    for car_name in car_names:
+        stem = re.sub(r"[^\w-]+", "_", dossier_filename(car_name)[:-4]).strip("._") or "vehicule"
+        name, n = stem + ".pdf", 1
+        while name.lower() in used: n += 1; name = f"{stem}_{n}.pdf"
+        used.add(name.lower())
+        names[car_name] = name
+    return names
+
+def _dossier_file(car_name, df_car, out_dir, arcname):
+    """Worker : écrit le dossier dans un fichier temporaire unique et renvoie (chemin, nom dans le ZIP)"""
+    fd, path = tempfile.mkstemp(dir=out_dir, suffix=".pdf")
+    with os.fdopen(fd, "wb") as f: f.write(generer_pdf_complet(car_name, df_car))
+    return path, arcname
+
+def export_flotte(jobs, zip_path, workers=None, progress=None):
+    """jobs = [(nom, lignes)] -> archive zip_path ; progress(fait, total, nom) après chaque véhicule. Renvoie {nom: erreur}"""
+    errors = {}
+    # spawn : forker le serveur Streamlit (multi-threadé) pourrait hériter de verrous tenus
+    ctx = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(zip_path) or None) as out_dir, \
+         zipfile.ZipFile(zip_path, "w", zipfile.ZIP_STORED) as zf, \
+         ProcessPoolExecutor(max_workers=min(workers or os.cpu_count() or 2, max(len(jobs), 1)), mp_context=ctx, initializer=_init_export_worker) as pool:
+        arcnames = zip_names([car_name for car_name, _ in jobs])
+        futures = {pool.submit(_dossier_file, car_name, df_car, out_dir, arcnames[car_name]): car_name for car_name, df_car in jobs}
+        for done, fut in enumerate(as_completed(futures), 1):
+            car_name = futures[fut]
+            try:
+                path, arcname = fut.result()
+                zf.write(path, arcname) # PDF déjà compressés : stockés tels quels
+                os.remove(path)
+            except Exception as e: errors[car_name] = str(e)
+            if progress: progress(done, len(futures), car_name)
+    return errors